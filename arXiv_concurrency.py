@@ -0,0 +1,116 @@
+import time
+import asyncio
+import collections
+
+# The number of downloads at the same time, adapted to the answers of the server (AIMD): it grows by `increase`
+# for each `limit` requests which are answered quickly and without errors, and it is multiplied by `decrease`
+# when the server throttles (403, 429, 503, or a Retry-After). The requests to a host are also at least
+# min_interval seconds apart, and wait for the Retry-After of the host.
+
+throttle_statuses = (403, 429, 503)
+
+
+class AdaptiveConcurrency:
+
+    def __init__(self, initial=2, minimum=1, maximum=16, increase=1.0, decrease=0.5, min_interval=0.2,
+                 latency_factor=2.0, max_error_rate=0.1):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.min_interval = min_interval
+        # a latency is healthy up to latency_factor times the usual one
+        self.latency_factor = latency_factor
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.next_start = {}  # host: time at which the next request may start
+        self.paused_until = {}  # host: end of its Retry-After
+        self.last_decrease = 0.0
+        self.base_latency = None
+        self.error_rate = 0.0  # moving average of the requests which fail on the server or the network
+        self.counts = collections.Counter()
+        self.decisions = []  # (seconds since the start, 'increase' or 'decrease', limit, reason)
+        self.time_start = time.monotonic()
+
+    def allowed(self):
+        return max(self.minimum, int(self.limit))
+
+    async def acquire(self, host):
+        # wait for a free slot, then for the interval and the Retry-After of the host. Returns the start time
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.allowed())
+            self.in_flight += 1
+        now = time.monotonic()
+        start = max(now, self.next_start.get(host, 0.0), self.paused_until.get(host, 0.0))
+        self.next_start[host] = start + self.min_interval
+        if start > now:
+            await asyncio.sleep(start - now)
+        return time.monotonic()
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def decide(self, decision, limit, reason):
+        self.decisions.append((time.monotonic() - self.time_start, decision, limit, reason))
+        print(f' Concurrency {decision}d to {max(self.minimum, int(limit))} after {reason}')
+
+    def record(self, host, time_request, status=None, latency=None, retry_after=None):
+        # the answer to a request started at time_request: its status (None if it failed on the network)
+        # and the seconds until its headers
+        now = time.monotonic()
+        self.counts['requests'] += 1
+        if status in throttle_statuses or retry_after is not None:
+            self.counts['throttled'] += 1
+            if retry_after is not None and retry_after.isdigit():
+                self.paused_until[host] = max(self.paused_until.get(host, 0.0), now + float(retry_after))
+            # the requests sent before the last decrease were throttled by the old limit, they do not count
+            if time_request >= self.last_decrease:
+                self.limit = max(float(self.minimum), self.limit * self.decrease)
+                self.last_decrease = now
+                self.decide('decrease', self.limit, f'HTTP {status}' + (f', Retry-After {retry_after}'
+                                                                        if retry_after is not None else ''))
+            return
+        failed = status is None or status >= 500
+        self.error_rate += 0.1 * (failed - self.error_rate)
+        if failed:
+            self.counts['errors'] += 1
+            return
+        self.counts['ok'] += 1
+        # the usual latency: the lowest, which slowly follows the latencies when they get higher
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        else:
+            self.base_latency += 0.05 * (latency - self.base_latency)
+        healthy = latency <= self.latency_factor * self.base_latency and self.error_rate <= self.max_error_rate
+        if healthy and self.limit < self.maximum:
+            allowed = self.allowed()
+            self.limit = min(float(self.maximum), self.limit + self.increase / self.limit)
+            if self.allowed() > allowed:
+                self.decide('increase', self.limit, f'{latency:.2f}s latency')
+                self.condition_changed()
+
+    def condition_changed(self):
+        # wake up the requests waiting for a slot, from a synchronous method
+        async def notify():
+            async with self.condition:
+                self.condition.notify_all()
+        asyncio.ensure_future(notify())
+
+    def metrics(self):
+        elapsed = time.monotonic() - self.time_start
+        return {
+            'limit': self.allowed(),
+            'in_flight': self.in_flight,
+            'requests': self.counts['requests'],
+            'ok': self.counts['ok'],
+            'throttled': self.counts['throttled'],
+            'errors': self.counts['errors'],
+            'requests_per_second': self.counts['requests'] / elapsed if elapsed > 0 else 0.0,
+            'increases': sum(1 for decision in self.decisions if decision[1] == 'increase'),
+            'decreases': sum(1 for decision in self.decisions if decision[1] == 'decrease'),
+            'base_latency': self.base_latency,
+        }
@@ -0,0 +1,15 @@
+import sqlite3
+import contextlib
+
+
+@contextlib.contextmanager
+def connect(path):
+    # a connection for each operation, committed at the end (rolled back on an error) and closed, so that the
+    # sqlite files (the index of the ids, the store of the downloads, the metadata cache) can be shared by
+    # threads and processes
+    connection = sqlite3.connect(path, timeout=60)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
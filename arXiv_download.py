@@ -1,63 +1,294 @@
 import os
+import re
 import csv
+import gzip
+import time
+import zlib
+import random
 import shutil
+import asyncio
+import tarfile
+import zipfile
+import argparse
+import threading
+import urllib.error
+import urllib.parse
 import urllib.request
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import aiohttp
+import arXiv_store
+from arXiv_store import DownloadStore, file_sha256, place_file
+from arXiv_id import ArxivIndex, parse_arxiv_id, normalize_arxiv_id, format_arxiv_id, get_file_id
+from arXiv_concurrency import AdaptiveConcurrency
+
+eprint_url = 'https://arxiv.org/e-print'
+# throttled (arXiv answers 403 too when it is) or unavailable, the request is sent again after a while
+retry_statuses = (403, 429, 500, 502, 503, 504)
+chunk_size = 64 * 1024
+# sha256 of each downloaded file of a directory, in the format of sha256sum
+checksum_filename = 'checksums.sha256'
+checksum_lock = threading.Lock()
+store = None  # the DownloadStore of download_source_with_cache, in arXiv_store.default_store_dir by default
+index = None  # the ArxivIndex of the ids of all the lists, in arXiv_id.default_index_path by default
+
+# A download goes to path.part, which is renamed to path once its size and content are checked. A .part left by
+# an interruption is resumed with a Range request, with an If-Range on the ETag or Last-Modified of the response
+# it was started from (kept in path.part.validator), so that a new version of the file is downloaded from the start.
+
+
+def load_checksums(save_dir):
+    # {file name: sha256}, the last line of a name is the current one
+    checksums = {}
+    path = os.path.join(save_dir, checksum_filename)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                digest, _, name = line.rstrip('\n').partition('  ')
+                if name:
+                    checksums[name] = digest
+    return checksums
+
+
+def record_checksum(path, digest):
+    with checksum_lock, open(os.path.join(os.path.dirname(path), checksum_filename), 'a', encoding='utf-8') as f:
+        f.write(f'{digest}  {os.path.basename(path)}\n')
+
+
+def is_complete_archive(path):
+    # whether a gzip, tar or zip file can be read to its end, and a PDF has its end marker. Other formats pass
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(4)
+            if head.startswith(b'\x1f\x8b'):
+                f.seek(0)
+                with gzip.GzipFile(fileobj=f) as gz:
+                    while gz.read(1024 * 1024):
+                        pass
+            elif head in (b'PK\x03\x04', b'PK\x05\x06'):
+                with zipfile.ZipFile(f) as zf:
+                    return zf.testzip() is None
+            elif head == b'%PDF':
+                f.seek(max(0, os.path.getsize(path) - 1024))
+                return b'%%EOF' in f.read()
+            elif tarfile.is_tarfile(path):
+                with tarfile.open(path, 'r:') as tf:
+                    for _ in tf:
+                        pass
+    except (OSError, EOFError, zlib.error, zipfile.BadZipFile, tarfile.TarError):
+        # zlib.error: a corrupt deflate stream
+        return False
+    return True
+
+
+def verify_download(path, checksums):
+    # a downloaded file is complete if it has its recorded checksum. One without a checksum (downloaded by an
+    # older version) is checked by reading the archive, and its checksum is recorded
+    name = os.path.basename(path)
+    if name in checksums:
+        return file_sha256(path) == checksums[name]
+    if not is_complete_archive(path):
+        return False
+    checksums[name] = file_sha256(path)
+    record_checksum(path, checksums[name])
+    return True
+
+
+def discard_part(part_path):
+    for path in (part_path, f'{part_path}.validator'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_range_headers(part_path):
+    # the headers to ask for the rest of a .part
+    if not os.path.exists(part_path) or os.path.getsize(part_path) == 0:
+        return {}
+    headers = {'Range': f'bytes={os.path.getsize(part_path)}-'}
+    if os.path.exists(f'{part_path}.validator'):
+        with open(f'{part_path}.validator', encoding='utf-8') as f:
+            headers['If-Range'] = f.read()
+    return headers
+
+
+def open_part(status, headers, part_path):
+    # the file to write the body of a response to, the expected size of the whole file (None if unknown),
+    # and whether the download is resumed
+    if status == 206:
+        match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', headers.get('Content-Range', ''))
+        if match is None or int(match.group(1)) != os.path.getsize(part_path):
+            discard_part(part_path)
+            raise IOError(f"unexpected Content-Range {headers.get('Content-Range')}")
+        total = int(match.group(2)) if match.group(2) != '*' else None
+        return open(part_path, 'ab'), total, True
+    # the whole file, from the start
+    discard_part(part_path)
+    validator = headers.get('ETag') or headers.get('Last-Modified')
+    if validator:
+        with open(f'{part_path}.validator', 'w', encoding='utf-8') as f:
+            f.write(validator)
+    total = headers.get('Content-Length')
+    return open(part_path, 'wb'), int(total) if total is not None else None, False
+
+
+def finish_part(part_path, path, total, resumed):
+    # check a .part whose body is written and rename it to path. Returns None, or the error.
+    # A short .part is kept to be resumed, one which is not a complete archive is discarded
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        return f'{size} of {total} bytes'
+    if (resumed or total is None) and not is_complete_archive(part_path):
+        discard_part(part_path)
+        return 'incomplete archive'
+    digest = file_sha256(part_path)
+    os.replace(part_path, path)
+    discard_part(part_path)
+    record_checksum(path, digest)
+    return None
+
 
 def download_source(number, path):
-    url = f'https://arxiv.org/e-print/{number}'
+    # download to path.part, resumed if it is there, and rename it to path once it is complete. number may have
+    # a version (2203.01252v3), which is then the one downloaded.
+    # Returns True if the file was downloaded
+    url = f'{eprint_url}/{number}'
     print('Downloading:', url)
+    part_path = f'{path}.part'
+    request = urllib.request.Request(url, headers=get_range_headers(part_path))
     try:
-        urllib.request.urlretrieve(url, path)
+        with urllib.request.urlopen(request, timeout=60) as response:
+            f, total, resumed = open_part(response.status, response.headers, part_path)
+            with f:
+                shutil.copyfileobj(response, f, chunk_size)
+        error = finish_part(part_path, path, total, resumed)
+    except urllib.error.HTTPError as e:
+        if e.code == 416:
+            # the .part is not a beginning of the file
+            discard_part(part_path)
+        error = f'HTTP {e.code}'
     except Exception as e:
-        print(f' Failed to download {number}: {e}')
+        error = str(e)
+    if error is not None:
+        print(f' Failed to download {number}: {error}')
+        return False
+    return True
 
 
-def download_source_with_cache(number, path):
-    cache_dir = 'cache_arxiv'
-    os.makedirs(cache_dir, exist_ok=True)
-    cache_path = os.path.join(cache_dir, 'last_downloaded_source.tar.gz')
-    cache_number_path = os.path.join(cache_dir, 'last_arxiv_number.txt')
+def get_store():
+    global store
+    if store is None:
+        store = DownloadStore()
+    return store
+
+
+def get_index():
+    global index
+    if index is None:
+        index = ArxivIndex()
+    return index
+
+
+def get_save_path(save_dir, number):
+    return os.path.join(save_dir, f'{get_file_id(number)}.tar.gz')
 
-    if os.path.exists(cache_path) and os.path.exists(cache_number_path):
-        last_number = open(cache_number_path).read().strip()
-        if last_number == number:
-            shutil.copyfile(cache_path, path)
-            print(f' Cache hit for {number}')
-            return
 
-    download_source(number, path)
-    shutil.copyfile(path, cache_path)
-    with open(cache_number_path, 'w') as f:
-        f.write(number)
+def link_from_store(number, path):
+    # put the e-print at path from the store if it is there, or from the place where another list downloaded it,
+    # with its checksum. Returns True if it was. The store is keyed by the id with its version, if any, so that
+    # 2203.01252v3 is never served the file of 2203.01252v1 or of the version-less id
+    digest = get_store().link(number, path)
+    if digest is None:
+        other_path = get_index().get_path(number)
+        if other_path is None or os.path.abspath(other_path) == os.path.abspath(path):
+            return False
+        # the file name has the version, the other list must have downloaded the same one
+        if os.path.basename(other_path) != os.path.basename(path):
+            return False
+        place_file(other_path, path)
+        digest = get_store().add(number, path)
+    record_checksum(path, digest)
+    print(f' Cache hit for {number}')
+    return True
+
+
+def add_download(number, path):
+    # a downloaded e-print goes into the store, and the index records where it is
+    get_store().add(number, path)
+    get_index().set_path(number, path)
+
+
+def download_source_with_cache(number, path):
+    # the e-print is linked from the store of downloads if it is there, otherwise downloaded and added to it.
+    # Returns True if the file is at path
+    with get_store().lock(number):
+        if link_from_store(number, path):
+            return True
+        if not download_source(number, path):
+            return False
+        add_download(number, path)
+    return True
 
 
 def extract_arxiv_number(url):
+    # the canonical arXiv id of a link, without version, None if it is not a link to arXiv
+    return normalize_arxiv_id(url)
+
+
+def read_arxiv_ids(csv_path):
+    # the canonical arXiv ids of a scraped list, without duplicates, which are recorded in the index. An id keeps
+    # the latest version linked by the list, e.g. 2203.01252v3, so that this version is downloaded
+    links = []
+    n_missing = 0
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            # pdf_url may be a link to the proceedings rather than to arXiv
+            urls = [row[key] for key in ('arxiv_url', 'pdf_url') if row.get(key)]
+            url = next((url for url in urls if extract_arxiv_number(url) is not None), None)
+            if url is None:
+                n_missing += 1
+                continue
+            links.append(url)
+    arxiv_ids = get_index().add(links, os.path.basename(csv_path))
+    if n_missing:
+        print(f'{n_missing} rows of {csv_path} have no arXiv URL')
+    if len(arxiv_ids) < len(links):
+        print(f'{len(links) - len(arxiv_ids)} duplicate links in {csv_path}')
+    versions = {}
+    for link in links:
+        arxiv_id, version = parse_arxiv_id(link)
+        versions[arxiv_id] = max(versions.get(arxiv_id) or 0, version or 0) or None
+    return [format_arxiv_id(arxiv_id, versions[arxiv_id]) for arxiv_id in arxiv_ids]
 
-    match = url.strip().split('/')[-1]
-    return match.replace('.pdf', '')
+
+def is_downloaded(arxiv_number, save_path, checksums):
+    # whether save_path is there and complete. An incomplete one (e.g. cut by an older version, which wrote
+    # save_path directly) is moved to save_path.part, so that only the missing bytes are downloaded
+    if not os.path.exists(save_path):
+        return False
+    if verify_download(save_path, checksums):
+        print(f'Already exists: {arxiv_number}')
+        return True
+    if os.stat(save_path).st_nlink > 1:
+        # linked from the store, which must not be written through it
+        print(f'Corrupt: {arxiv_number}, downloading it again')
+        os.remove(save_path)
+        return False
+    print(f'Incomplete or corrupt: {arxiv_number}, resuming it')
+    os.replace(save_path, f'{save_path}.part')
+    return False
 
 
 def batch_download_from_csv(csv_path, save_dir='downloads/cvpr2022', max_workers=2):
     os.makedirs(save_dir, exist_ok=True)
+    checksums = load_checksums(save_dir)
 
     tasks = []
-    with open(csv_path, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            url = row.get('pdf_url') or row.get('arxiv_url')
-            if not url:
-                print('Missing URL in row:', row)
-                continue
+    for arxiv_number in read_arxiv_ids(csv_path):
+        save_path = get_save_path(save_dir, arxiv_number)
 
-            arxiv_number = extract_arxiv_number(url)
-            save_path = os.path.join(save_dir, f'{arxiv_number}.tar.gz')
+        if is_downloaded(arxiv_number, save_path, checksums):
+            continue
 
-            if os.path.exists(save_path):
-                print(f'Already exists: {arxiv_number}')
-                continue
-
-            tasks.append((arxiv_number, save_path))
+        tasks.append((arxiv_number, save_path))
 
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
@@ -70,5 +301,139 @@ def batch_download_from_csv(csv_path, save_dir='downloads/cvpr2022', max_workers
                 print(f'Error during downloading: {e}')
 
 
+def get_retry_delay(attempt, backoff, retry_after=None):
+    # exponential backoff with full jitter, or the Retry-After of the server if it gives one in seconds
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+    return random.uniform(0, backoff * 2 ** attempt)
+
+
+async def download_source_async(session, number, path, retries=5, backoff=1.0, limiter=None):
+    """
+    Downloads the e-print of one paper with an aiohttp session, whose connections are kept alive between papers.
+    The body is streamed to path.part by chunks and renamed to path once it is complete, a response which is
+    throttled (403, 429), fails on the server (5xx), is cut or times out is retried up to `retries` times, from where
+    the .part stopped. Each request waits for a slot of `limiter` (an AdaptiveConcurrency), and its answer is
+    reported to it.
+    Returns True if the file was downloaded.
+    """
+    url = f'{eprint_url}/{number}'
+    host = urllib.parse.urlsplit(url).netloc
+    part_path = f'{path}.part'
+    for attempt in range(retries + 1):
+        retry_after = None
+        time_request = await limiter.acquire(host) if limiter is not None else time.monotonic()
+        status = None
+        try:
+            print('Downloading:', url)
+            async with session.get(url, headers=get_range_headers(part_path)) as response:
+                status = response.status
+                if status in retry_statuses:
+                    retry_after = response.headers.get('Retry-After')
+                if limiter is not None:
+                    limiter.record(host, time_request, status, time.monotonic() - time_request, retry_after)
+                if status in retry_statuses:
+                    error = f'HTTP {status}'
+                elif status == 416:
+                    # the .part is not a beginning of the file, which is downloaded again from the start
+                    discard_part(part_path)
+                    error = 'HTTP 416'
+                else:
+                    response.raise_for_status()
+                    f, total, resumed = open_part(status, response.headers, part_path)
+                    with f:
+                        async for chunk in response.content.iter_chunked(chunk_size):
+                            f.write(chunk)
+                    error = finish_part(part_path, path, total, resumed)
+                    if error is None:
+                        return True
+        except aiohttp.ClientResponseError as e:
+            # not found, which does not change by retrying
+            print(f' Failed to download {number}: HTTP {e.status}')
+            return False
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            if limiter is not None and status is None:
+                limiter.record(host, time_request)
+            error = f'{type(e).__name__}: {e}'
+        finally:
+            if limiter is not None:
+                await limiter.release()
+        if attempt < retries:
+            delay = get_retry_delay(attempt, backoff, retry_after)
+            print(f' Retrying {number} in {delay:.1f}s after {error}')
+            await asyncio.sleep(delay)
+    print(f' Failed to download {number} after {retries + 1} attempts: {error}')
+    return False
+
+
+async def download_sources_async(tasks, concurrency=4, retries=5, backoff=1.0, timeout=60, limiter=None):
+    """
+    Downloads the (number, path) of `tasks` over one pool of keep-alive connections. The number of downloads at
+    the same time starts at `concurrency` and is adapted to the answers of the server by `limiter`, an
+    AdaptiveConcurrency which is made if None (its metrics are read after). `timeout` is the number of seconds
+    to wait for a connection or for the next chunk.
+    Returns {number: True if downloaded}.
+    """
+    if limiter is None:
+        limiter = AdaptiveConcurrency(initial=concurrency, maximum=max(concurrency, 4 * concurrency))
+    connector = aiohttp.TCPConnector(limit=limiter.maximum)
+    client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+    # the files are saved as they are served, a gzip Content-Encoding included, as urllib does
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout, auto_decompress=False) as session:
+        # an unexpected error fails its paper only, the other downloads go on
+        results = await asyncio.gather(*(download_source_async(session, number, path, retries, backoff, limiter)
+                                         for number, path in tasks), return_exceptions=True)
+    for (number, _), result in zip(tasks, results):
+        if isinstance(result, BaseException):
+            print(f' Failed to download {number}: {type(result).__name__}: {result}')
+    return {number: result is True for (number, _), result in zip(tasks, results)}
+
+
+def batch_download_async(csv_path, save_dir='downloads/cvpr2022', concurrency=4, retries=5, backoff=1.0, timeout=60,
+                         max_concurrency=16, min_interval=0.2):
+    # same as batch_download_from_csv, with download_sources_async. The papers in the store are linked from it,
+    # and the ones downloaded are added to it. The concurrency starts at `concurrency` and adapts up to
+    # max_concurrency, with requests at least min_interval seconds apart
+    os.makedirs(save_dir, exist_ok=True)
+    checksums = load_checksums(save_dir)
+    tasks = []
+    for arxiv_number in read_arxiv_ids(csv_path):
+        save_path = get_save_path(save_dir, arxiv_number)
+        if is_downloaded(arxiv_number, save_path, checksums) or link_from_store(arxiv_number, save_path):
+            continue
+        tasks.append((arxiv_number, save_path))
+    limiter = AdaptiveConcurrency(initial=concurrency, maximum=max(concurrency, max_concurrency),
+                                  min_interval=min_interval)
+    results = asyncio.run(download_sources_async(tasks, concurrency, retries, backoff, timeout, limiter))
+    for arxiv_number, save_path in tasks:
+        if results[arxiv_number]:
+            add_download(arxiv_number, save_path)
+    print(f'{sum(results.values())} of {len(tasks)} papers downloaded')
+    metrics = limiter.metrics()
+    print(f"{metrics['requests']} requests, {metrics['requests_per_second']:.1f}/s, {metrics['throttled']} throttled, "
+          f"{metrics['errors']} errors, concurrency {metrics['limit']} after {metrics['increases']} increases "
+          f"and {metrics['decreases']} decreases")
+    return results
+
+
 if __name__ == '__main__':
-    batch_download_from_csv('cvpr2022arXiv.csv', max_workers=2)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Download the arXiv sources of a scraped list')
+    parser.add_argument('csv_path', nargs='?', default='cvpr2022arXiv.csv')
+    parser.add_argument('--save-dir', default='downloads/cvpr2022')
+    parser.add_argument('--concurrency', '-c', type=int, default=4, help='papers downloaded at the same time at first')
+    parser.add_argument('--max-concurrency', type=int, default=16,
+                        help='papers downloaded at the same time while the server answers well')
+    parser.add_argument('--min-interval', type=float, default=0.2, help='seconds between two requests')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='retries of a paper after a 403, a 429, a 5xx or a timeout')
+    parser.add_argument('--backoff', type=float, default=1.0,
+                        help='seconds of the first retry delay, doubled each time')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for a connection or for data')
+    parser.add_argument('--store-dir', default=None, help='store of the downloads shared by all the lists')
+    parser.add_argument('--store-size', type=float, default=None, help='GB kept in the store')
+    args = parser.parse_args()
+    if args.store_dir is not None or args.store_size is not None:
+        store = DownloadStore(args.store_dir or arXiv_store.default_store_dir,
+                              int(args.store_size * 1024 ** 3) if args.store_size else arXiv_store.default_store_bytes)
+    batch_download_async(args.csv_path, args.save_dir, args.concurrency, args.retries, args.backoff, args.timeout,
+                         args.max_concurrency, args.min_interval)
\ No newline at end of file
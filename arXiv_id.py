@@ -0,0 +1,140 @@
+import os
+import re
+import time
+import arXiv_db
+
+# The same paper appears as abs/2203.01252, pdf/2203.01252v2.pdf, e-print/2203.01252, arXiv:2203.01252 or, for the
+# papers before 2007, cs/0601001 or math.AG/0601001. normalize_arxiv_id gives one key for all of them, the id
+# without its version, and ArxivIndex keeps every id seen in the scraped lists, in which lists, and where it was
+# downloaded, so that a paper is fetched once whatever the list or the link.
+
+default_index_path = 'arxiv_ids.sqlite'
+
+# new style since 2007: YYMM.NNNN (4 digits until 2014, 5 after), old style: archive(.subject class)/YYMMNNN
+pattern_arxiv_id = re.compile(r'(?:arxiv:)?(?:(?P<new>\d{4}\.\d{4,5})|(?P<archive>[a-z][a-z\-]*)'
+                              r'(?:\.[a-z]{2})?/(?P<number>\d{7}))(?:v(?P<version>\d+))?', re.IGNORECASE)
+# the paths of the pages of a paper on arxiv.org (and export.arxiv.org), the id follows them
+pattern_arxiv_url = re.compile(r'^(?:https?://)?(?:www\.|export\.)?arxiv\.org/(?:abs|pdf|e-print|src|format)/',
+                               re.IGNORECASE)
+
+schema = '''
+CREATE TABLE IF NOT EXISTS papers (
+    arxiv_id TEXT PRIMARY KEY,      -- without version
+    version INTEGER,                -- the latest version seen in a link, if any
+    path TEXT,                      -- where the e-print was downloaded
+    first_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sightings (
+    arxiv_id TEXT NOT NULL,
+    source TEXT NOT NULL,           -- the scraped list
+    link TEXT,
+    PRIMARY KEY (arxiv_id, source)
+);
+'''
+
+
+def parse_arxiv_id(text):
+    # (id without version, version or None) of an id or of a link to arxiv.org, None if there is none
+    text = text.strip()
+    url_match = pattern_arxiv_url.match(text)
+    if url_match is not None:
+        text = re.split(r'[?#]', text[url_match.end():])[0].rstrip('/')
+        if text.lower().endswith('.pdf'):
+            text = text[:-4]
+    match = pattern_arxiv_id.fullmatch(text)
+    if match is None:
+        return None
+    if match.group('new'):
+        arxiv_id = match.group('new')
+    else:
+        # the subject class is not part of the id, math.AG/0601001 is math/0601001
+        arxiv_id = f"{match.group('archive').lower()}/{match.group('number')}"
+    version = int(match.group('version')) if match.group('version') else None
+    return arxiv_id, version
+
+
+def normalize_arxiv_id(text):
+    # the canonical id (without version) of an id or a link, None if it is not one
+    parsed = parse_arxiv_id(text)
+    return parsed[0] if parsed is not None else None
+
+
+def format_arxiv_id(arxiv_id, version=None):
+    # the id with its version, if any: 2203.01252v3
+    return f'{arxiv_id}v{version}' if version else arxiv_id
+
+
+def get_file_id(arxiv_id):
+    # the id as a file name: cs/0601001 is cs_0601001
+    return arxiv_id.replace('/', '_')
+
+
+class ArxivIndex:
+
+    def __init__(self, path=default_index_path):
+        self.path = path
+        with self.connect() as connection:
+            connection.executescript(schema)
+
+    def connect(self):
+        return arXiv_db.connect(self.path)
+
+    def add(self, links, source):
+        # record the papers of a scraped list. Returns their canonical ids, in order and without duplicates,
+        # the links which are not arXiv ids are skipped
+        arxiv_ids = {}
+        for link in links:
+            parsed = parse_arxiv_id(link)
+            if parsed is None:
+                print(f'Not an arXiv id: {link}')
+                continue
+            arxiv_id, version = parsed
+            if arxiv_id not in arxiv_ids or (version or 0) > (arxiv_ids[arxiv_id][0] or 0):
+                arxiv_ids[arxiv_id] = (version, link)
+        now = time.time()
+        with self.connect() as connection:
+            connection.executemany('INSERT OR IGNORE INTO papers (arxiv_id, first_seen) VALUES (?, ?)',
+                                   [(arxiv_id, now) for arxiv_id in arxiv_ids])
+            connection.executemany('UPDATE papers SET version = ? WHERE arxiv_id = ? '
+                                   'AND (version IS NULL OR version < ?)',
+                                   [(version, arxiv_id, version) for arxiv_id, (version, _) in arxiv_ids.items()
+                                    if version is not None])
+            connection.executemany('INSERT OR REPLACE INTO sightings (arxiv_id, source, link) VALUES (?, ?, ?)',
+                                   [(arxiv_id, source, link) for arxiv_id, (_, link) in arxiv_ids.items()])
+        return list(arxiv_ids)
+
+    def get_path(self, arxiv_id):
+        # where the e-print of a paper was downloaded, if the file is still there. The id may have a version
+        arxiv_id = normalize_arxiv_id(arxiv_id) or arxiv_id
+        with self.connect() as connection:
+            row = connection.execute('SELECT path FROM papers WHERE arxiv_id = ?', (arxiv_id,)).fetchone()
+        if row is None or row[0] is None or not os.path.exists(row[0]):
+            return None
+        return row[0]
+
+    def set_path(self, arxiv_id, path):
+        arxiv_id = normalize_arxiv_id(arxiv_id) or arxiv_id
+        with self.connect() as connection:
+            connection.execute('INSERT OR IGNORE INTO papers (arxiv_id, first_seen) VALUES (?, ?)',
+                               (arxiv_id, time.time()))
+            connection.execute('UPDATE papers SET path = ? WHERE arxiv_id = ?', (os.path.abspath(path), arxiv_id))
+
+    def get_versions(self):
+        # {arxiv_id: the latest version seen in a link} of the papers of which a link has a version
+        with self.connect() as connection:
+            return dict(connection.execute('SELECT arxiv_id, version FROM papers WHERE version IS NOT NULL'))
+
+    def sources(self, arxiv_id):
+        arxiv_id = normalize_arxiv_id(arxiv_id) or arxiv_id
+        with self.connect() as connection:
+            return [source for source, in connection.execute(
+                'SELECT source FROM sightings WHERE arxiv_id = ? ORDER BY source', (arxiv_id,))]
+
+    def stats(self):
+        # (number of papers, number of lists, number of papers in more than one list)
+        with self.connect() as connection:
+            n_papers, = connection.execute('SELECT COUNT(*) FROM papers').fetchone()
+            n_sources, = connection.execute('SELECT COUNT(DISTINCT source) FROM sightings').fetchone()
+            n_shared, = connection.execute('SELECT COUNT(*) FROM (SELECT arxiv_id FROM sightings GROUP BY arxiv_id '
+                                           'HAVING COUNT(*) > 1)').fetchone()
+        return n_papers, n_sources, n_shared
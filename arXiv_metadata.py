@@ -0,0 +1,284 @@
+import csv
+import time
+import json
+import sqlite3
+import argparse
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+import arXiv_db
+from arXiv_id import parse_arxiv_id, normalize_arxiv_id
+from arXiv_download import read_arxiv_ids, get_index, get_retry_delay, retry_statuses
+
+# The abstracts, authors, categories, versions and dates of the papers, from the arXiv API. Hundreds of ids go
+# in each id_list query, the Atom feed is parsed as it arrives, and the entries are kept in a local cache, so that
+# only the papers which are not there, or were fetched more than max_age days ago, or have a newer version in a
+# scraped list, are asked again.
+
+api_url = 'https://export.arxiv.org/api/query'
+default_cache_path = 'arxiv_metadata.sqlite'
+# ids per query, the API answers up to 2000 entries. The ids are sent in the body of a POST, not in the URL
+batch_size = 200
+# the API asks for at most one request every 3 seconds
+request_interval = 3.0
+
+namespaces = {
+    'atom': 'http://www.w3.org/2005/Atom',
+    'arxiv': 'http://arxiv.org/schemas/atom',
+    'opensearch': 'http://a9.com/-/spec/opensearch/1.1/',
+}
+tag_entry = f"{{{namespaces['atom']}}}entry"
+tag_total_results = f"{{{namespaces['opensearch']}}}totalResults"
+
+schema = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    arxiv_id TEXT PRIMARY KEY,      -- without version
+    version INTEGER,                -- the latest version
+    title TEXT,                     -- NULL if arXiv does not know the id
+    summary TEXT,
+    authors TEXT,                   -- JSON list
+    categories TEXT,                -- JSON list, the primary one first
+    published TEXT,
+    updated TEXT,
+    doi TEXT,
+    journal_ref TEXT,
+    comment TEXT,
+    fetched REAL NOT NULL
+);
+'''
+fields = ['arxiv_id', 'version', 'title', 'summary', 'authors', 'categories', 'published', 'updated', 'doi',
+          'journal_ref', 'comment']
+
+
+class ApiError(Exception):
+    # the API answered an error entry, e.g. for an id in a format it does not accept
+    pass
+
+
+def get_text(element, path):
+    # the text of a child with the spaces and line breaks of the feed collapsed, None if it is not there
+    child = element.find(path, namespaces)
+    if child is None or child.text is None:
+        return None
+    return ' '.join(child.text.split())
+
+
+def parse_entry(element):
+    # the metadata of an entry of the feed, None for the entries of the errors of the API
+    parsed = parse_arxiv_id(get_text(element, 'atom:id') or '')
+    if parsed is None:
+        return None
+    arxiv_id, version = parsed
+    categories = [category.get('term') for category in element.findall('atom:category', namespaces)]
+    primary = element.find('arxiv:primary_category', namespaces)
+    if primary is not None and primary.get('term') in categories:
+        categories.remove(primary.get('term'))
+        categories.insert(0, primary.get('term'))
+    return {
+        'arxiv_id': arxiv_id,
+        'version': version,
+        'title': get_text(element, 'atom:title'),
+        'summary': get_text(element, 'atom:summary'),
+        'authors': [get_text(author, 'atom:name') for author in element.findall('atom:author', namespaces)],
+        'categories': categories,
+        'published': get_text(element, 'atom:published'),
+        'updated': get_text(element, 'atom:updated'),
+        'doi': get_text(element, 'arxiv:doi'),
+        'journal_ref': get_text(element, 'arxiv:journal_ref'),
+        'comment': get_text(element, 'arxiv:comment'),
+    }
+
+
+def parse_feed(stream, feed=None):
+    # the entries of an Atom feed, read from a file or a response as it arrives: each entry is parsed when its
+    # end tag is read, then removed from the tree. The number of results announced by the feed goes in
+    # feed['total_results']. Raises ApiError for the error entries of the API
+    for _, element in ElementTree.iterparse(stream, events=('end',)):
+        if element.tag == tag_total_results and feed is not None:
+            feed['total_results'] = int(element.text)
+        if element.tag != tag_entry:
+            continue
+        entry = parse_entry(element)
+        if entry is None:
+            raise ApiError(get_text(element, 'atom:summary') or 'error entry')
+        element.clear()
+        yield entry
+
+
+class MetadataCache:
+
+    def __init__(self, path=default_cache_path):
+        self.path = path
+        with self.connect() as connection:
+            connection.executescript(schema)
+
+    def connect(self):
+        return arXiv_db.connect(self.path)
+
+    def stale(self, arxiv_ids, max_age, versions=None):
+        # the ids which are not in the cache, were fetched more than max_age seconds ago, or of which versions
+        # ({arxiv_id: version}, e.g. from the links of the lists) has a newer version
+        with self.connect() as connection:
+            cached = {arxiv_id: (version, fetched) for arxiv_id, version, fetched in
+                      connection.execute('SELECT arxiv_id, version, fetched FROM metadata')}
+        versions = versions or {}
+        limit = time.time() - max_age
+        stale = []
+        for arxiv_id in arxiv_ids:
+            version, fetched = cached.get(arxiv_id, (None, 0.0))
+            if fetched < limit or (versions.get(arxiv_id) or 0) > (version or 0):
+                stale.append(arxiv_id)
+        return stale
+
+    def put(self, entries, missing=()):
+        # record the entries of a feed, and the ids which arXiv does not know, so that they are not asked again
+        # until they are stale
+        now = time.time()
+        with self.connect() as connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO metadata ({', '.join(fields)}, fetched) "
+                f"VALUES ({', '.join('?' * (len(fields) + 1))})",
+                [tuple(json.dumps(entry[field]) if field in ('authors', 'categories') else entry[field]
+                       for field in fields) + (now,) for entry in entries])
+            connection.executemany(
+                'INSERT OR REPLACE INTO metadata (arxiv_id, fetched) VALUES (?, ?)',
+                [(arxiv_id, now) for arxiv_id in missing])
+
+    def get(self, arxiv_ids):
+        # {arxiv_id: metadata} of the ids in the cache which arXiv knows
+        with self.connect() as connection:
+            connection.row_factory = sqlite3.Row
+            rows = {row['arxiv_id']: row for row in
+                    connection.execute('SELECT * FROM metadata WHERE title IS NOT NULL')}
+        metadata = {}
+        for arxiv_id in arxiv_ids:
+            if arxiv_id in rows:
+                entry = {field: rows[arxiv_id][field] for field in fields}
+                entry['authors'] = json.loads(entry['authors'])
+                entry['categories'] = json.loads(entry['categories'])
+                metadata[arxiv_id] = entry
+        return metadata
+
+    def stats(self):
+        # (number of papers, number of ids unknown to arXiv)
+        with self.connect() as connection:
+            return connection.execute('SELECT COUNT(*), COUNT(*) - COUNT(title) FROM metadata').fetchone()
+
+
+class MetadataClient:
+
+    def __init__(self, url=api_url, interval=request_interval, retries=5, backoff=3.0, timeout=60):
+        self.url = url
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.next_request = 0.0
+        self.requests = 0
+
+    def wait_interval(self):
+        now = time.monotonic()
+        if self.next_request > now:
+            time.sleep(self.next_request - now)
+        self.next_request = time.monotonic() + self.interval
+
+    def query(self, arxiv_ids):
+        # the entries of the papers of one id_list query, retried when the API is busy, or answers fewer entries
+        # than the results it announces, which it sometimes does under load. The ids which arXiv does not know
+        # are not in the results
+        data = urllib.parse.urlencode({'id_list': ','.join(arxiv_ids), 'start': 0,
+                                       'max_results': len(arxiv_ids)}).encode()
+        for attempt in range(self.retries + 1):
+            self.wait_interval()
+            self.requests += 1
+            retry_after = None
+            try:
+                feed = {}
+                with urllib.request.urlopen(self.url, data, timeout=self.timeout) as response:
+                    entries = list(parse_feed(response, feed))
+                if len(entries) >= feed.get('total_results', 0):
+                    return entries
+                error = f"{len(entries)} of {feed['total_results']} entries"
+            except urllib.error.HTTPError as e:
+                if e.code not in retry_statuses:
+                    raise
+                error = f'HTTP {e.code}'
+                retry_after = e.headers.get('Retry-After')
+            except (urllib.error.URLError, TimeoutError, ElementTree.ParseError) as e:
+                error = f'{type(e).__name__}: {e}'
+            if attempt < self.retries:
+                delay = get_retry_delay(attempt, self.backoff, retry_after)
+                print(f' Retrying {len(arxiv_ids)} ids in {delay:.1f}s after {error}')
+                time.sleep(delay)
+        raise ConnectionError(f'{error} after {self.retries + 1} attempts')
+
+    def fetch(self, arxiv_ids):
+        # (entries, ids which arXiv does not know) of the ids. An id which the API rejects makes it answer only
+        # an error, the batch is then split in two until the id is alone
+        try:
+            entries = self.query(arxiv_ids)
+        except ApiError as e:
+            if len(arxiv_ids) == 1:
+                print(f' No metadata for {arxiv_ids[0]}: {e}')
+                return [], list(arxiv_ids)
+            middle = len(arxiv_ids) // 2
+            entries_first, missing_first = self.fetch(arxiv_ids[:middle])
+            entries_second, missing_second = self.fetch(arxiv_ids[middle:])
+            return entries_first + entries_second, missing_first + missing_second
+        found = {entry['arxiv_id'] for entry in entries}
+        return entries, [arxiv_id for arxiv_id in arxiv_ids if arxiv_id not in found]
+
+
+def update_metadata(arxiv_ids, cache, client=None, max_age=30 * 86400, versions=None, size=batch_size):
+    # fetch the metadata of the stale ids in batches of size ids and put it in the cache.
+    # Returns (number of ids fetched, number of requests)
+    client = client or MetadataClient()
+    stale = cache.stale(list(dict.fromkeys(arxiv_ids)), max_age, versions)
+    requests = client.requests
+    for start in range(0, len(stale), size):
+        batch = stale[start:start + size]
+        print(f'Fetching metadata: {start + len(batch)}/{len(stale)}')
+        try:
+            entries, missing = client.fetch(batch)
+        except Exception as e:
+            print(f' Failed to fetch {len(batch)} ids: {e}')
+            continue
+        cache.put(entries, missing)
+    return len(stale), client.requests - requests
+
+
+def export_metadata(arxiv_ids, cache, csv_path):
+    # write the metadata of the ids in the cache to a CSV, with the lists in the format of the scraped CSVs
+    metadata = cache.get(arxiv_ids)
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for arxiv_id in arxiv_ids:
+            if arxiv_id in metadata:
+                writer.writerow({field: str(value) if isinstance(value, list) else value
+                                 for field, value in metadata[arxiv_id].items()})
+    return len(metadata)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch the arXiv metadata of the papers of scraped lists')
+    parser.add_argument('csv_paths', nargs='*', default=['cvpr2022arXiv.csv'])
+    parser.add_argument('--cache', default=default_cache_path)
+    parser.add_argument('--max-age', type=float, default=30, help='days after which an entry is fetched again')
+    parser.add_argument('--batch-size', type=int, default=batch_size, help='ids per query')
+    parser.add_argument('--api-url', default=api_url)
+    parser.add_argument('--interval', type=float, default=request_interval, help='seconds between two requests')
+    parser.add_argument('--output', default=None, help='CSV to write the metadata of the papers to')
+    args = parser.parse_args()
+    # the latest version is asked, the versions linked by the lists only make the older entries stale
+    arxiv_ids = list(dict.fromkeys(normalize_arxiv_id(arxiv_id) for csv_path in args.csv_paths
+                                   for arxiv_id in read_arxiv_ids(csv_path)))
+    cache = MetadataCache(args.cache)
+    n_fetched, n_requests = update_metadata(arxiv_ids, cache, MetadataClient(args.api_url, args.interval),
+                                            args.max_age * 86400, get_index().get_versions(), args.batch_size)
+    n_papers, n_unknown = cache.stats()
+    print(f'{n_fetched} of {len(arxiv_ids)} papers fetched in {n_requests} requests, '
+          f'{n_papers} in the cache of which {n_unknown} unknown to arXiv')
+    if args.output:
+        print(f'{export_metadata(arxiv_ids, cache, args.output)} papers written to {args.output}')
@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import concurrent.futures
+from arXiv_download import download_source_with_cache, read_arxiv_ids, load_checksums, is_downloaded, get_save_path
+
+# the converter is run from its own directory, with flat imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'latex2txt'))
+import arXiv2txt
+
+# Downloads and conversion at the same time: download threads put the archives in a bounded queue as they
+# land, and each archive is converted in its own process (arXiv2txt.start_isolated), with a timeout and a memory
+# limit. When the converters fall behind, the queue fills up and the downloads wait, so that at most queue_size
+# archives are downloaded ahead of the conversion. The papers which are up to date in the manifest of output_dir
+# are not converted again.
+
+
+def download_stage(arxiv_ids, save_dir, downloaded, download_workers, download=download_source_with_cache):
+    # put (arxiv_id, archive_path, seconds of download, error or None) in the queue for each paper, then None when
+    # all are done. An archive which is already there and complete is not downloaded again
+    checksums = load_checksums(save_dir)
+
+    def fetch(arxiv_id):
+        save_path = get_save_path(save_dir, arxiv_id)
+        time_start = time.monotonic()
+        error = None
+        try:
+            if not is_downloaded(arxiv_id, save_path, checksums):
+                download(arxiv_id, save_path)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        finally:
+            # every paper reaches the converters, a failed one as a failure
+            downloaded.put((arxiv_id, save_path, time.monotonic() - time_start, error))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as executor:
+            for future in [executor.submit(fetch, arxiv_id) for arxiv_id in arxiv_ids]:
+                future.result()
+    finally:
+        downloaded.put(None)
+
+
+def run_pipeline(arxiv_ids, save_dir='downloads/cvpr2022', output_dir='processed', download_workers=2,
+                 convert_workers=None, queue_size=None, download=download_source_with_cache, timeout=None,
+                 memory_limit=None, force=False):
+    # download and convert the papers, at most convert_workers processes (the number of cores by default) convert
+    # the archives as soon as they are downloaded. A conversion is killed after `timeout` seconds and fails over
+    # memory_limit bytes. With force=True, the papers up to date in the manifest are converted again.
+    # Returns {arxiv_id: (success, error, seconds of download, seconds of conversion)}
+    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    convert_workers = convert_workers or os.cpu_count()
+    downloaded = queue.Queue(maxsize=queue_size or 2 * convert_workers)
+    producer = threading.Thread(target=download_stage,
+                                args=(arxiv_ids, save_dir, downloaded, download_workers, download), daemon=True)
+    manifest = arXiv2txt.load_manifest(output_dir)
+    arXiv2txt.save_manifest(output_dir, manifest)
+    converter_version = arXiv2txt.get_converter_version()
+    time_start = time.monotonic()
+    producer.start()
+
+    results = {}
+    archive_rows = {}  # archive_path: archive columns of the manifest
+    download_seconds = {}  # archive_path: (arxiv_id, seconds of download)
+
+    def record(arxiv_id, success, error, seconds, convert_seconds):
+        results[arxiv_id] = (success, error, seconds, convert_seconds)
+        print(f'[{len(results)}/{len(arxiv_ids)}] {"done" if success else "failed"}: {arxiv_id}')
+
+    def start(item):
+        # start the conversion of a downloaded paper, unless it failed or is up to date
+        arxiv_id, archive_path, seconds, error = item
+        if error is None and (not os.path.exists(archive_path) or os.path.getsize(archive_path) == 0):
+            error = 'download failed'
+        if error is not None:
+            record(arxiv_id, False, error, seconds, 0.0)
+            return
+        paper_id = arXiv2txt.get_paper_id(os.path.basename(archive_path))
+        row = manifest.get(paper_id)
+        archive_row = arXiv2txt.get_archive_row(archive_path, paper_id, None, row)
+        if not force and arXiv2txt.is_up_to_date(row, archive_row, converter_version, output_dir):
+            record(arxiv_id, True, None, seconds, 0.0)
+            return
+        try:
+            archive_row['archive_format'] = arXiv2txt.sniff_format(archive_path)
+        except Exception as e:
+            record(arxiv_id, False, f'{type(e).__name__}: {e}', seconds, 0.0)
+            return
+        archive_rows[archive_path] = archive_row
+        download_seconds[archive_path] = (arxiv_id, seconds)
+        task = (archive_path, paper_id, output_dir, archive_row['archive_format'])
+        receiver, process = arXiv2txt.start_isolated(task, memory_limit)
+        running[receiver] = (process, task, time.monotonic())
+
+    running = {}  # receiving end of the pipe: (process, task, time_start)
+    finished = False
+    while not finished or running:
+        # take a new archive only when a converter is free, so that the queue gives the backpressure
+        while not finished and len(running) < convert_workers:
+            try:
+                item = downloaded.get(block=not running)
+            except queue.Empty:
+                break
+            if item is None:
+                finished = True
+            else:
+                start(item)
+        if not running:
+            continue
+        for archive_path, success, error, convert_seconds in arXiv2txt.collect_isolated(running, timeout, wait=0.1):
+            arxiv_id, seconds = download_seconds.pop(archive_path)
+            row = arXiv2txt.get_result_row(archive_rows.pop(archive_path), converter_version, output_dir, success,
+                                           error, convert_seconds)
+            manifest[row['arxiv_id']] = row
+            arXiv2txt.append_manifest(output_dir, row)
+            record(arxiv_id, success, error, seconds, convert_seconds)
+    producer.join()
+    arXiv2txt.save_manifest(output_dir, manifest)
+
+    wall = time.monotonic() - time_start
+    n_done = sum(1 for result in results.values() if result[0])
+    download_seconds = sum(result[2] for result in results.values())
+    convert_seconds = sum(result[3] for result in results.values())
+    print(f'{n_done} of {len(results)} papers processed in {wall:.1f}s, '
+          f'{download_seconds:.1f}s of downloads over {download_workers} threads and '
+          f'{convert_seconds:.1f}s of conversion over {convert_workers} processes')
+    for arxiv_id, (success, error, _, _) in results.items():
+        if not success:
+            print(f'failed: {arxiv_id}' + (f' ({error})' if error else ''))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download the arXiv sources of scraped lists and convert them to '
+                                                 'text as they arrive')
+    parser.add_argument('csv_paths', nargs='*', default=['cvpr2022arXiv.csv'])
+    parser.add_argument('--save-dir', default='downloads/cvpr2022')
+    parser.add_argument('--output-dir', default='processed')
+    parser.add_argument('--download-workers', type=int, default=2, help='papers downloaded at the same time')
+    parser.add_argument('--convert-workers', type=int, default=0,
+                        help='papers converted at the same time, 0 for the number of cores')
+    parser.add_argument('--queue-size', type=int, default=0,
+                        help='archives downloaded ahead of the conversion, twice the convert workers by default')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which a conversion is killed')
+    parser.add_argument('--memory-limit', type=int, default=None, help='MB of address space for each conversion')
+    parser.add_argument('--force', action='store_true', help='convert all the papers, even those up to date')
+    args = parser.parse_args()
+    arxiv_ids = list(dict.fromkeys(arxiv_id for csv_path in args.csv_paths
+                                   for arxiv_id in read_arxiv_ids(csv_path)))
+    run_pipeline(arxiv_ids, args.save_dir, args.output_dir, args.download_workers, args.convert_workers,
+                 args.queue_size, timeout=args.timeout,
+                 memory_limit=args.memory_limit * 1024 * 1024 if args.memory_limit else None, force=args.force)
@@ -0,0 +1,291 @@
+import os
+import sys
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from arXiv_download import download_source_with_cache, read_arxiv_ids, get_save_path
+
+# the converter is run from its own directory, with flat imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'latex2txt'))
+
+# A queue of papers in a SQLite file on the filesystem shared by the nodes. Each paper is downloaded, then
+# converted. A worker claims a paper with a lease that it renews by heartbeats while it works on it. A lease
+# which is not renewed expires and the paper goes back to the queue, and a worker whose lease was taken over
+# does not record its result, so that each stage of a paper is completed once.
+
+default_lease = 300  # seconds a claim lasts without a heartbeat
+max_attempts = 3  # claims of a stage before the paper is marked failed
+
+schema = '''
+CREATE TABLE IF NOT EXISTS papers (
+    arxiv_id TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,            -- download or convert
+    status TEXT NOT NULL,           -- pending, leased, done or failed
+    owner TEXT,                     -- worker holding the lease
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    seconds REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS papers_status ON papers (status, lease_expires);
+'''
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+
+    def __init__(self, path, lease=default_lease):
+        self.path = path
+        self.lease = lease
+        # no WAL, which does not work on network filesystems. Writers wait for each other up to the timeout
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock at once, so that two workers never claim the same paper
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def add(self, arxiv_ids, stage='download'):
+        # papers which are already in the queue are left as they are. Returns the number added
+        connection = self.transaction()
+        try:
+            n = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO papers (arxiv_id, stage, status, updated_at) "
+                                   "VALUES (?, ?, 'pending', ?)",
+                                   [(arxiv_id, stage, time.time()) for arxiv_id in arxiv_ids])
+            n = connection.total_changes - n
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return n
+
+    def claim(self, owner):
+        # a pending paper, or one whose lease has expired. Returns (arxiv_id, stage) or None
+        now = time.time()
+        connection = self.transaction()
+        try:
+            row = connection.execute("SELECT arxiv_id, stage, attempts FROM papers WHERE status = 'pending' "
+                                     "OR (status = 'leased' AND lease_expires < ?) LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                arxiv_id, stage, attempts = row
+                if attempts >= max_attempts:
+                    # claimed that many times without a result, its workers were probably killed by it
+                    connection.execute("UPDATE papers SET status = 'failed', owner = NULL, error = ?, updated_at = ? "
+                                       "WHERE arxiv_id = ?", (f'lease expired {attempts} times', now, arxiv_id))
+                    row = ()
+                else:
+                    connection.execute("UPDATE papers SET status = 'leased', owner = ?, lease_expires = ?, "
+                                       "attempts = attempts + 1, updated_at = ? WHERE arxiv_id = ?",
+                                       (owner, now + self.lease, now, arxiv_id))
+                    row = (arxiv_id, stage)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        # a paper given up on is not returned, the next one is claimed instead
+        return self.claim(owner) if row == () else row
+
+    def heartbeat(self, arxiv_id, owner):
+        # renew the lease, False if it is not held any more
+        cursor = self.connection.execute("UPDATE papers SET lease_expires = ? WHERE arxiv_id = ? AND owner = ? "
+                                         "AND status = 'leased'", (time.time() + self.lease, arxiv_id, owner))
+        return cursor.rowcount == 1
+
+    def finish(self, arxiv_id, owner, success, error=None, seconds=None, next_stage=None):
+        # record the result of a stage if the lease is still held, then the paper goes on to next_stage.
+        # Returns False if the lease was lost, the result is then dropped
+        if success and next_stage is not None:
+            status, stage, attempts = 'pending', next_stage, 0
+        else:
+            status, stage, attempts = ('done' if success else 'failed'), None, None
+        cursor = self.connection.execute(
+            "UPDATE papers SET status = ?, stage = COALESCE(?, stage), attempts = COALESCE(?, attempts), "
+            "owner = NULL, lease_expires = NULL, error = ?, seconds = ?, updated_at = ? "
+            "WHERE arxiv_id = ? AND owner = ? AND status = 'leased'",
+            (status, stage, attempts, error, seconds, time.time(), arxiv_id, owner))
+        return cursor.rowcount == 1
+
+    def release_expired(self):
+        # give the papers of the expired leases back to the queue. Returns their number
+        cursor = self.connection.execute("UPDATE papers SET status = 'pending', owner = NULL, lease_expires = NULL "
+                                         "WHERE status = 'leased' AND lease_expires < ?", (time.time(),))
+        return cursor.rowcount
+
+    def retry_failed(self):
+        cursor = self.connection.execute("UPDATE papers SET status = 'pending', attempts = 0, error = NULL "
+                                         "WHERE status = 'failed'")
+        return cursor.rowcount
+
+    def count(self, status):
+        return self.connection.execute("SELECT COUNT(*) FROM papers WHERE status = ?", (status,)).fetchone()[0]
+
+    def status(self, window=600):
+        # {(stage, status): number of papers}, the papers done in the last `window` seconds, and the workers
+        counts = dict(((stage, status), n) for stage, status, n in self.connection.execute(
+            "SELECT stage, status, COUNT(*) FROM papers GROUP BY stage, status"))
+        n_recent = self.connection.execute("SELECT COUNT(*) FROM papers WHERE status = 'done' AND updated_at > ?",
+                                           (time.time() - window,)).fetchone()[0]
+        owners = [owner for owner, in self.connection.execute(
+            "SELECT DISTINCT owner FROM papers WHERE status = 'leased' AND owner IS NOT NULL")]
+        return counts, n_recent, owners
+
+
+class Heartbeat(threading.Thread):
+    # renews the lease of the paper a worker is working on, every third of the lease
+
+    def __init__(self, path, arxiv_id, owner, lease):
+        super().__init__(daemon=True)
+        self.path = path
+        self.arxiv_id = arxiv_id
+        self.owner = owner
+        self.lease = lease
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        # sqlite connections stay in the thread which made them
+        queue = JobQueue(self.path, self.lease)
+        try:
+            while not self.stopped.wait(self.lease / 3):
+                if not queue.heartbeat(self.arxiv_id, self.owner):
+                    self.lost = True
+                    print(f'Lease of {self.arxiv_id} lost by {self.owner}')
+                    break
+        finally:
+            queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def download_paper(arxiv_id, save_dir):
+    save_path = get_save_path(save_dir, arxiv_id)
+    # download_source prints the errors
+    if not download_source_with_cache(arxiv_id, save_path):
+        return False, 'download failed'
+    return True, None
+
+
+def convert_paper(arxiv_id, save_dir, output_dir):
+    import arXiv2txt
+    archive_path = get_save_path(save_dir, arxiv_id)
+    _, success, error = arXiv2txt.process_archive(archive_path, arXiv2txt.get_paper_id(os.path.basename(archive_path)),
+                                                  output_dir)
+    # process_archive prints why a paper has no text, the error is only for exceptions
+    return success, error or (None if success else 'conversion failed')
+
+
+def run_worker(path, save_dir, output_dir, lease=default_lease, poll=5):
+    # claim papers until the queue has none pending or leased, waiting for the leases of other workers
+    # in case they expire
+    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    queue = JobQueue(path, lease)
+    owner = get_worker_name()
+    n_done = 0
+    try:
+        while True:
+            claimed = queue.claim(owner)
+            if claimed is None:
+                if queue.count('leased') == 0:
+                    break
+                time.sleep(poll)
+                continue
+            arxiv_id, stage = claimed
+            heartbeat = Heartbeat(path, arxiv_id, owner, lease)
+            heartbeat.start()
+            time_start = time.monotonic()
+            try:
+                if stage == 'download':
+                    success, error = download_paper(arxiv_id, save_dir)
+                else:
+                    success, error = convert_paper(arxiv_id, save_dir, output_dir)
+            except Exception as e:
+                success, error = False, f'{type(e).__name__}: {e}'
+            finally:
+                heartbeat.stop()
+            seconds = time.monotonic() - time_start
+            next_stage = 'convert' if stage == 'download' else None
+            if queue.finish(arxiv_id, owner, success, error, seconds, next_stage):
+                n_done += 1
+                print(f'[{owner}] {stage} {"done" if success else "failed"} in {seconds:.1f}s: {arxiv_id}')
+            else:
+                print(f'[{owner}] {stage} of {arxiv_id} dropped, the lease was taken over')
+    finally:
+        queue.close()
+    return n_done
+
+
+def print_status(path, window=600):
+    queue = JobQueue(path)
+    try:
+        queue.release_expired()
+        counts, n_recent, owners = queue.status(window)
+    finally:
+        queue.close()
+    print(f'{"stage":<10}{"pending":>9}{"leased":>9}{"done":>9}{"failed":>9}')
+    for stage in ('download', 'convert'):
+        print(f'{stage:<10}' + ''.join(f'{counts.get((stage, status), 0):>9}'
+                                       for status in ('pending', 'leased', 'done', 'failed')))
+    depth = sum(n for (_, status), n in counts.items() if status in ('pending', 'leased'))
+    print(f'queue depth {depth}, {n_recent} papers done in the last {window // 60} min '
+          f'({n_recent / window * 60:.1f}/min), {len(owners)} workers busy')
+    for owner in owners:
+        print(f'  {owner}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download and convert arXiv papers with workers on several nodes, '
+                                                 'through a queue in a shared SQLite file')
+    parser.add_argument('--db', default='queue.db', help='the queue, on a filesystem shared by the nodes')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add_parser = commands.add_parser('add', help='queue the papers of scraped lists')
+    add_parser.add_argument('csv_paths', nargs='+')
+    add_parser.add_argument('--save-dir', default='downloads/cvpr2022',
+                            help='papers whose archive is already there are only converted')
+    add_parser.add_argument('--retry-failed', action='store_true', help='queue the failed papers again')
+    work_parser = commands.add_parser('work', help='run workers on this node until the queue is empty')
+    work_parser.add_argument('--workers', '-n', type=int, default=2)
+    work_parser.add_argument('--save-dir', default='downloads/cvpr2022')
+    work_parser.add_argument('--output-dir', default='processed')
+    work_parser.add_argument('--lease', type=float, default=default_lease, help='seconds a claim lasts')
+    status_parser = commands.add_parser('status', help='queue depth and throughput')
+    status_parser.add_argument('--window', type=int, default=600, help='seconds over which throughput is measured')
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        queue = JobQueue(args.db)
+        arxiv_ids = list(dict.fromkeys(arxiv_id for csv_path in args.csv_paths
+                                       for arxiv_id in read_arxiv_ids(csv_path)))
+        downloaded = [arxiv_id for arxiv_id in arxiv_ids
+                      if os.path.exists(get_save_path(args.save_dir, arxiv_id))]
+        n = queue.add(downloaded, 'convert')
+        n += queue.add(arxiv_ids, 'download')
+        print(f'{n} of {len(arxiv_ids)} papers queued, {len(downloaded)} already downloaded')
+        if args.retry_failed:
+            print(f'{queue.retry_failed()} failed papers queued again')
+        queue.close()
+    elif args.command == 'work':
+        processes = [multiprocessing.Process(target=run_worker, args=(args.db, args.save_dir, args.output_dir,
+                                                                       args.lease))
+                     for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        print_status(args.db)
+    else:
+        print_status(args.db, args.window)
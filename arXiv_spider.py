@@ -4,7 +4,9 @@ from bs4 import BeautifulSoup
 import csv
 import re
 import html
+import os
 import concurrent.futures
+from arXiv_id import ArxivIndex, normalize_arxiv_id
 
 
 def fetch_html(batch):
@@ -53,10 +55,11 @@ def parse_arxivs(html_text):
             # 替换 \\/ 为 /（反转义）
             arxiv_link = arxiv_tag["href"].replace("\\/", "/")
 
-            # 去重处理
-            if arxiv_link in seen_links:
+            # 去重处理, by arXiv id, the same paper may have several links (abs, pdf, versions)
+            key = normalize_arxiv_id(arxiv_link) or arxiv_link
+            if key in seen_links:
                 continue
-            seen_links.add(arxiv_link)
+            seen_links.add(key)
 
             print(f"No. {len(arxivs) + 1} paper:")
             print("arXiv URL:", arxiv_link)
@@ -94,19 +97,31 @@ def fetch_and_parse(batch):
 
 
 
-def main():
+def main(path="cvpr2023arXiv.csv"):
     max_batch = 3
     all_arxivs = []
+    seen_ids = set()
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
         futures = [executor.submit(fetch_and_parse, batch) for batch in range(max_batch)]
 
         for future in concurrent.futures.as_completed(futures):
             arxivs = future.result()
-            all_arxivs.extend(arxivs)
-
-    save_csv(all_arxivs)
+            # the batches may share papers too
+            for arxiv in arxivs:
+                key = normalize_arxiv_id(arxiv["arxiv_url"]) or arxiv["arxiv_url"]
+                if key not in seen_ids:
+                    seen_ids.add(key)
+                    all_arxivs.append(arxiv)
+
+    save_csv(all_arxivs, path)
     print(f"\n has captured a total of {len(all_arxivs)} arxivs and saved them to the CSV file ")
 
+    # the index of all the lists, the papers already downloaded for another list are not downloaded again
+    index = ArxivIndex()
+    arxiv_ids = index.add([arxiv["arxiv_url"] for arxiv in all_arxivs], os.path.basename(path))
+    n_shared = sum(1 for arxiv_id in arxiv_ids if len(index.sources(arxiv_id)) > 1)
+    print(f" {n_shared} of them are in other lists too")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,127 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+import arXiv_db
+
+# A store of the downloaded e-prints shared by all the lists and years: each file is kept once in
+# objects/ under its sha256, and an index maps the arXiv id (with its version, if any) to the hash. The
+# download directories get hard links to the files of the store instead of copies. When the store is over
+# max_bytes, the files used least recently are removed from it, the links in the download directories stay.
+
+default_store_dir = 'cache_arxiv'
+default_store_bytes = 20 * 1024 ** 3
+
+schema = '''
+CREATE TABLE IF NOT EXISTS papers (
+    key TEXT PRIMARY KEY,           -- arXiv id, with its version if any
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS papers_sha256 ON papers (sha256);
+'''
+
+
+def file_sha256(path):
+    hash_object = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hash_object.update(block)
+    return hash_object.hexdigest()
+
+
+def place_file(source, path):
+    # a hard link to source at path, or a copy on another filesystem. Through a temporary name, so that
+    # path is either the old file or the whole new one
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, path)
+
+
+class DownloadStore:
+
+    def __init__(self, root=default_store_dir, max_bytes=default_store_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        with self.connect() as connection:
+            connection.executescript(schema)
+
+    def connect(self):
+        return arXiv_db.connect(os.path.join(self.root, 'index.sqlite'))
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def lock(self, key):
+        # the threads of a process which download the same paper wait for each other, so that it is fetched once
+        with self.locks_lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def lookup(self, key):
+        # (sha256, size) of a paper in the store, or None
+        with self.connect() as connection:
+            return connection.execute('SELECT sha256, size FROM papers WHERE key = ?', (key,)).fetchone()
+
+    def link(self, key, path):
+        # put the file of a paper at path. Returns its sha256, or None if it is not in the store
+        row = self.lookup(key)
+        if row is None:
+            return None
+        digest, size = row
+        blob_path = self.blob_path(digest)
+        try:
+            if os.path.getsize(blob_path) != size:
+                return None
+            place_file(blob_path, path)
+        except FileNotFoundError:
+            # evicted meanwhile
+            return None
+        with self.connect() as connection:
+            connection.execute('UPDATE papers SET last_used = ? WHERE key = ?', (time.time(), key))
+        return digest
+
+    def add(self, key, path, digest=None):
+        # add the downloaded file at path, linked rather than copied. Returns its sha256
+        if digest is None:
+            digest = file_sha256(path)
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            place_file(path, blob_path)
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO papers (key, sha256, size, last_used) VALUES (?, ?, ?, ?)',
+                               (key, digest, os.path.getsize(blob_path), time.time()))
+        self.evict()
+        return digest
+
+    def evict(self):
+        # remove the files used least recently until the store is at most max_bytes. Returns the bytes removed
+        with self.connect() as connection:
+            blobs = connection.execute('SELECT sha256, MAX(size), MAX(last_used) FROM papers GROUP BY sha256 '
+                                       'ORDER BY MAX(last_used)').fetchall()
+            total = sum(size for _, size, _ in blobs)
+            removed = 0
+            for digest, size, _ in blobs:
+                if total - removed <= self.max_bytes:
+                    break
+                connection.execute('DELETE FROM papers WHERE sha256 = ?', (digest,))
+                if os.path.exists(self.blob_path(digest)):
+                    os.remove(self.blob_path(digest))
+                removed += size
+        return removed
+
+    def stats(self):
+        # (number of papers, number of files, bytes)
+        with self.connect() as connection:
+            n_papers, = connection.execute('SELECT COUNT(*) FROM papers').fetchone()
+            n_files, n_bytes = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM '
+                                                  '(SELECT MAX(size) AS size FROM papers GROUP BY sha256)').fetchone()
+        return n_papers, n_files, n_bytes
@@ -4,6 +4,7 @@ import csv
 import re
 import html
 import concurrent.futures
+from arXiv_id import ArxivIndex, normalize_arxiv_id
 
 def fetch_html(batch):
     url = "https://papercopilot.com/wp-admin/admin-ajax.php"
@@ -141,6 +142,12 @@ def main():
     save_csv(all_papers)
     print(f"\n has captured a total of {len(all_papers)} papers and saved them to the CSV file ")
 
+    # the papers whose pdf_url is on arXiv go into the index of all the lists
+    arxiv_urls = [paper["pdf_url"] for paper in all_papers
+                  if paper["pdf_url"] and normalize_arxiv_id(paper["pdf_url"]) is not None]
+    if arxiv_urls:
+        ArxivIndex().add(arxiv_urls, "cvpr2022.csv")
+
 if __name__ == "__main__":
     main()
 
@@ -14,6 +14,7 @@ os.makedirs(app_dir, exist_ok=True)
 
 from . import encode_process
 from . import cache
+from . import source_process
 from . import file_process
 from . import text_process
 from . import latex_process
@@ -1,139 +1,418 @@
-import shutil
-import tempfile
+import csv
+import glob
+import gzip
+import hashlib
 import zipfile
 import tarfile
-import sys
 import os
-from translatex import process_latex_file
-import re
-
-
-
-def find_main_tex_file(base_dir):
-    for root, _, files in os.walk(base_dir):
-        for file in files:
-            if file.endswith('.tex'):
-                full_path = os.path.join(root, file)
-                with open(full_path, encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                    if r'\begin{document}' in content:
-                        return full_path
-    return None
-
-
-def resolve_tex_file(file_path, base_dir, visited=None):
-    if visited is None:
-        visited = set()
-    resolved_text = ''
-    if file_path in visited:
-        return ''
-    visited.add(file_path)
-    try:
-        with open(file_path, encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        return f'% File not found: {file_path}\n'
-
-    for line in lines:
-        match = re.match(r'\\(input|include)\{(.+?)\}', line.strip())
-        if match:
-            sub_path = match.group(2)
-            if not sub_path.endswith('.tex'):
-                sub_path += '.tex'
-            full_sub_path = os.path.join(base_dir, sub_path)
-            if os.path.exists(full_sub_path):
-                resolved_text += resolve_tex_file(full_sub_path, base_dir, visited)
-            else:
-                resolved_text += f'% WARNING: missing file {sub_path}\n'
-        else:
-            resolved_text += line
-    return resolved_text
-
-
-
-def extract_tex_from_archive(archive_path, paper_dir, output_base):
-    import tempfile
-    import shutil
-    import os
-
-    success = False
-    temp_dir = tempfile.mkdtemp()
+import math
+import time
+import zlib
+import argparse
+import multiprocessing
+import multiprocessing.connection
+from translatex import convert_latex
+import source_process
+import datetime
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where the memory limit is not applied
+    resource = None
+
+
+
+source_extensions = ('.tex', '.bbl', '.sty', '.cls', '.bib')
+# the e-prints are all saved as .tar.gz, their real format is sniffed
+archive_extensions = ('.tar.gz', '.tgz', '.zip', '.tar', '.gz', '.pdf')
+max_source_bytes = 64 * 1024 * 1024  # text sources kept in memory for one archive, the rest are skipped
+# one row per arXiv id in output_dir, a paper is converted again only if its row is not up to date
+manifest_filename = 'manifest.csv'
+manifest_fields = ['arxiv_id', 'archive', 'archive_format', 'archive_size', 'archive_mtime_ns', 'archive_sha256',
+                   'converter_version', 'output', 'output_sha256', 'status', 'error', 'seconds', 'processed_at']
+
+
+def sniff_format(archive_path):
+    # the format of a downloaded e-print from its first bytes, whatever its extension:
+    # 'tar.gz', 'gzip' (a single gzipped file), 'tar', 'zip', 'pdf' or 'unknown'
+    with open(archive_path, 'rb') as f:
+        head = f.read(512)
+        if head.startswith(b'\x1f\x8b'):
+            # only the first block is decompressed, to look for the tar header
+            f.seek(0)
+            try:
+                with gzip.GzipFile(fileobj=f) as gz:
+                    block = gz.read(512)
+            except (OSError, EOFError, zlib.error):
+                return 'unknown'
+            return 'tar.gz' if block[257:262] == b'ustar' else 'gzip'
+    if head.startswith((b'PK\x03\x04', b'PK\x05\x06')):
+        return 'zip'
+    if head.startswith(b'%PDF'):
+        return 'pdf'
+    if head[257:262] == b'ustar':
+        return 'tar'
+    return 'unknown'
+
+
+def get_paper_id(archive):
+    # the arXiv id of a downloaded e-print, which is named {arxiv id}.tar.gz
+    for extension in archive_extensions:
+        if archive.endswith(extension):
+            return archive[:-len(extension)]
+    return archive
+
+
+def read_archive_sources(archive_path, archive_format=None):
+    # read the text sources of an archive member by member, without writing anything to disk.
+    # Returns {normalized path in the archive: bytes}, or None if the format has no LaTeX sources
+    if archive_format is None:
+        archive_format = sniff_format(archive_path)
+    sources = {}
+    total = 0
+
+    def keep(name, size):
+        nonlocal total
+        if not name.endswith(source_extensions):
+            return False
+        if total + size > max_source_bytes:
+            print(f"Skipped {name} of {archive_path}: more than {max_source_bytes} bytes of sources")
+            return False
+        total += size
+        return True
 
+    if archive_format == 'zip':
+        with zipfile.ZipFile(archive_path, 'r') as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and keep(info.filename, info.file_size):
+                    sources[os.path.normpath(info.filename)] = zf.read(info)
+    elif archive_format in ('tar.gz', 'tar'):
+        with tarfile.open(archive_path, 'r|gz' if archive_format == 'tar.gz' else 'r|') as tf:
+            for member in tf:
+                if member.isfile() and keep(member.name, member.size):
+                    sources[os.path.normpath(member.name)] = tf.extractfile(member).read()
+    elif archive_format == 'gzip':
+        # arXiv serves a paper with a single .tex file gzipped, without tar
+        with gzip.open(archive_path, 'rb') as gz:
+            data = gz.read(max_source_bytes + 1)
+        if keep('main.tex', len(data)):
+            sources['main.tex'] = data
+    else:
+        return None
+    return sources
+
+
+def extract_tex_from_archive(archive_path, paper_id, output_base, archive_format=None):
+    # the archive is read in memory and only its text sources are kept, figures and other binaries are skipped.
+    # The resolved latex is converted in memory and only the text is written, to output_base/{paper_id}.txt.
+    # The format is sniffed from the first bytes if it is not given
+
+    if archive_format is None:
+        archive_format = sniff_format(archive_path)
+    if archive_format == 'pdf':
+        print(f"Only a PDF, no LaTeX source: {archive_path}")
+        return False
     try:
-
-        if archive_path.endswith('.zip'):
-            with zipfile.ZipFile(archive_path, 'r') as zf:
-                zf.extractall(temp_dir)
-        elif archive_path.endswith(('.tar.gz', '.tgz')):
-            with tarfile.open(archive_path, 'r:gz') as tf:
-                tf.extractall(temp_dir)
-        else:
-            print(f"Unsupported archive type: {archive_path}")
-            return False
-        success = True
+        sources = read_archive_sources(archive_path, archive_format)
     except Exception as e:
         print(f"Decompression failed: {archive_path}, error: {e}")
         return False
+    if sources is None:
+        print(f"Unsupported archive type: {archive_path}")
+        return False
 
-    if success:
-
-        os.makedirs(paper_dir, exist_ok=True)
-
-
-        for fname in os.listdir(temp_dir):
-            src = os.path.join(temp_dir, fname)
-            dst = os.path.join(paper_dir, fname)
-            if os.path.isdir(src):
-                shutil.copytree(src, dst, dirs_exist_ok=True)
-            else:
-                shutil.copy2(src, dst)
-
-
-        main_tex_path = find_main_tex_file(paper_dir)
-        if not main_tex_path:
-            print(f"Main tex not found in: {archive_path}")
-            shutil.rmtree(paper_dir)
-            return False
-
-        full_tex = resolve_tex_file(main_tex_path, paper_dir)
-
-
-        main_tex_final_path = os.path.join(output_base, 'main.tex')
-        with open(main_tex_final_path, 'w', encoding='utf-8') as f:
-            f.write(full_tex)
+    tree = source_process.SourceTree(sources)
+    main_tex_name = tree.find_main()
+    if not main_tex_name:
+        print(f"Main tex not found in: {archive_path}")
+        return False
 
-        result_txt_path = os.path.join(output_base, 'result.txt')
+    full_tex = tree.resolve(main_tex_name)
+    del sources, tree
 
+    try:
+        text, stats = convert_latex(full_tex)
+    except Exception as e:
+        print(f"✗ Failed to process {archive_path}: {e}")
+        return False
 
-        try:
-            process_latex_file(main_tex_final_path, result_txt_path)
+    # named after the paper, so that papers converted at the same time do not overwrite each other
+    result_txt_path = os.path.join(output_base, f'{paper_id}.txt')
+    with open(result_txt_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    print(f"✓ Processed: {archive_path} -> {result_txt_path}, {stats['input_chars']} -> {stats['output_chars']} "
+          f"characters in {stats['seconds']:.1f}s")
+    return True
 
-            print(f"✓ Processed: {archive_path}")
-        except Exception as e:
-            print(f"✗ Failed to process {archive_path}: {e}")
 
-        shutil.rmtree(paper_dir)
+def process_archive(archive_path, paper_id, output_base, archive_format=None):
+    # one paper in a worker process, an error is returned instead of raised so that the batch goes on
+    try:
+        return archive_path, extract_tex_from_archive(archive_path, paper_id, output_base, archive_format), None
+    except Exception as e:
+        return archive_path, False, f'{type(e).__name__}: {e}'
 
-        if os.path.exists(main_tex_final_path):
-            os.remove(main_tex_final_path)
 
-        return True
+def estimate_cost(archive_path, archive_format=None):
+    # bytes of .tex in the archive, then the archive size, to start the most expensive papers first.
+    # Only headers are read: a compressed tar would have to be decompressed in full, its size is used instead
+    size = os.path.getsize(archive_path)
+    tex_bytes = size
+    try:
+        if archive_format == 'zip':
+            with zipfile.ZipFile(archive_path, 'r') as zf:
+                tex_bytes = sum(info.file_size for info in zf.infolist() if info.filename.endswith('.tex'))
+        elif archive_format == 'tar':
+            # the data of the members is skipped with seeks
+            with tarfile.open(archive_path, 'r:') as tf:
+                tex_bytes = sum(member.size for member in tf if member.name.endswith('.tex'))
+        elif archive_format == 'gzip':
+            # the size of the uncompressed file (modulo 2**32) is at the end of a gzip file
+            with open(archive_path, 'rb') as f:
+                f.seek(-4, os.SEEK_END)
+                tex_bytes = int.from_bytes(f.read(4), 'little')
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+        # the paper fails when it is converted, it is only scheduled by its size
+        print(f'Could not read the headers of {archive_path}: {e}')
+    return tex_bytes, size
+
+
+def run_isolated(archive_path, paper_id, output_base, archive_format, memory_limit, connection):
+    # target of the worker process of one paper, with at most memory_limit bytes of address space
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    connection.send(process_archive(archive_path, paper_id, output_base, archive_format))
+    connection.close()
+
+
+def start_isolated(task, memory_limit=None):
+    # start the worker process of one paper, task is (archive_path, paper_id, output_base, archive_format).
+    # Returns the receiving end of its pipe and the process
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run_isolated, args=(*task, memory_limit, sender), daemon=True)
+    process.start()
+    sender.close()
+    return receiver, process
+
+
+def collect_isolated(running, timeout=None, wait=1):
+    # wait at most `wait` seconds for the papers of running ({receiver: (process, task, time_start)}) to finish.
+    # The papers which finished, crashed or ran for more than `timeout` seconds are removed from running.
+    # Yields their (archive_path, success, error, seconds)
+    ready = multiprocessing.connection.wait(list(running), timeout=wait)
+    for receiver in list(running):
+        process, (archive_path, _, _, _), time_start = running[receiver]
+        if receiver in ready:
+            try:
+                result = receiver.recv()
+            except EOFError:
+                process.join()
+                result = (archive_path, False, f'worker exited with code {process.exitcode}')
+        elif timeout is not None and time.monotonic() - time_start > timeout:
+            process.kill()
+            result = (archive_path, False, f'killed after the timeout of {timeout}s')
+        else:
+            continue
+        process.join()
+        receiver.close()
+        del running[receiver]
+        yield (*result, time.monotonic() - time_start)
+
+
+def schedule_papers(tasks, jobs, timeout=None, memory_limit=None):
+    # run each paper in its own process, the most expensive first and at most `jobs` at a time.
+    # A paper which runs for more than `timeout` seconds is killed, and one which goes over memory_limit fails.
+    # Yields (archive_path, success, error, seconds) as the papers finish
+    pending = sorted(tasks, key=lambda task: estimate_cost(task[0], task[3]))
+    running = {}  # receiving end of the pipe: (process, task, time_start)
+    while pending or running:
+        while pending and len(running) < jobs:
+            task = pending.pop()
+            receiver, process = start_isolated(task, memory_limit)
+            running[receiver] = (process, task, time.monotonic())
+        yield from collect_isolated(running, timeout)
+
+
+def percentile(values, p):
+    # nearest-rank percentile of a non-empty list
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def file_sha256(path):
+    hash_object = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hash_object.update(block)
+    return hash_object.hexdigest()
+
+
+def get_converter_version():
+    # the hash of the sources of the converter, so that changing the code converts the papers again
+    hash_object = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        with open(path, 'rb') as f:
+            hash_object.update(f.read())
+    return hash_object.hexdigest()[0:20]
+
+
+def load_manifest(output_dir):
+    # {arxiv_id: row}. Rows are appended as the papers finish, the last row of an id is the current one
+    path = os.path.join(output_dir, manifest_filename)
+    manifest = {}
+    if os.path.exists(path):
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                manifest[row['arxiv_id']] = row
+    return manifest
+
+
+def save_manifest(output_dir, manifest):
+    # rewrite the manifest with one row per id, through a temporary file so that it is never left half written
+    path = os.path.join(output_dir, manifest_filename)
+    with open(path + '.tmp', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=manifest_fields)
+        writer.writeheader()
+        for arxiv_id in sorted(manifest):
+            writer.writerow(manifest[arxiv_id])
+    os.replace(path + '.tmp', path)
+
+
+def append_manifest(output_dir, row):
+    with open(os.path.join(output_dir, manifest_filename), 'a', newline='', encoding='utf-8') as f:
+        csv.DictWriter(f, fieldnames=manifest_fields).writerow(row)
+
+
+def get_archive_row(archive_path, paper_id, archive_format, row=None):
+    # the archive columns of the manifest. The hash of the previous row is kept if the size and mtime are the same
+    stat = os.stat(archive_path)
+    archive_row = {'arxiv_id': paper_id, 'archive': os.path.basename(archive_path), 'archive_format': archive_format,
+                   'archive_size': str(stat.st_size), 'archive_mtime_ns': str(stat.st_mtime_ns)}
+    if row is not None and all(row.get(key) == archive_row[key] for key in ('archive_size', 'archive_mtime_ns')):
+        archive_row['archive_sha256'] = row['archive_sha256']
+    else:
+        archive_row['archive_sha256'] = file_sha256(archive_path)
+    return archive_row
+
+
+def get_result_row(archive_row, converter_version, output_dir, success, error, seconds):
+    # the manifest row of a converted paper, with the hash of its output
+    row = dict(archive_row, converter_version=converter_version, output='', output_sha256='',
+               status='done' if success else 'failed', error=error or '', seconds=f'{seconds:.3f}',
+               processed_at=datetime.datetime.now().isoformat(timespec='seconds'))
+    output = f"{row['arxiv_id']}.txt"
+    if success and os.path.exists(os.path.join(output_dir, output)):
+        row['output'] = output
+        row['output_sha256'] = file_sha256(os.path.join(output_dir, output))
+    return row
+
+
+def is_up_to_date(row, archive_row, converter_version, output_dir):
+    # converted without error, by the same converter, from the same archive, and the output is still there as written
+    if row is None or row['status'] != 'done' or row['converter_version'] != converter_version:
+        return False
+    if row['archive_sha256'] != archive_row['archive_sha256']:
+        return False
+    output_path = os.path.join(output_dir, row['output'])
+    return os.path.exists(output_path) and file_sha256(output_path) == row['output_sha256']
 
 
-def batch_process_latex(root_dir='downloads/cvpr2022', output_dir='processed'):
+def batch_process_latex(root_dir='downloads/cvpr2022', output_dir='processed', jobs=1, timeout=None,
+                        memory_limit=None, force=False):
+    # with jobs > 1, or a timeout (seconds) or memory_limit (bytes), each paper is converted in its own process
+    # by schedule_papers. Only the papers which are new, changed or failed in the manifest of output_dir are
+    # converted, all of them with force=True.
+    # Returns the (archive_path, success, error, seconds) of each paper converted in the order they complete
     os.makedirs(output_dir, exist_ok=True)
-    archives = [f for f in os.listdir(root_dir) if f.endswith(('.zip', '.tar.gz', '.tgz'))]
-
-    for idx, archive in enumerate(archives):
-        paper_id = f'paper_{idx + 1:04d}'
-        paper_dir = os.path.join(output_dir, paper_id)
+    archives = sorted(f for f in os.listdir(root_dir) if f.endswith(archive_extensions))
+    manifest = load_manifest(output_dir)
+    # one row per id again, the rows appended by the previous run are merged
+    save_manifest(output_dir, manifest)
+    converter_version = get_converter_version()
+
+    tasks = []
+    formats = {}
+    archive_rows = {}
+    unreadable = []  # (archive_path, success, error, seconds) of the archives whose format could not be read
+    n_unchanged = 0
+    for archive in archives:
+        # one output per arXiv id, {paper_id}.txt
+        paper_id = get_paper_id(archive)
 
         archive_path = os.path.join(root_dir, archive)
-        print(f'processing {archive_path} -> {paper_id}')
-
-        extract_tex_from_archive(archive_path,paper_dir,output_dir)
+        row = manifest.get(paper_id)
+        archive_rows[archive_path] = get_archive_row(archive_path, paper_id, None, row)
+        if not force and is_up_to_date(row, archive_rows[archive_path], converter_version, output_dir):
+            # the archive was only touched or copied, its new size and mtime spare hashing it next time
+            row.update(archive_size=archive_rows[archive_path]['archive_size'],
+                       archive_mtime_ns=archive_rows[archive_path]['archive_mtime_ns'])
+            n_unchanged += 1
+            continue
+        try:
+            formats[archive_path] = sniff_format(archive_path)
+            error = None
+        except Exception as e:
+            formats[archive_path] = 'unknown'
+            error = f'{type(e).__name__}: {e}'
+        archive_rows[archive_path]['archive_format'] = formats[archive_path]
+        if error is not None:
+            # a damaged download fails alone, the batch goes on
+            unreadable.append((archive_path, False, error, 0.0))
+            continue
+        tasks.append((archive_path, paper_id, output_dir, formats[archive_path]))
+    if n_unchanged:
+        print(f'{n_unchanged} of {len(archives)} papers are up to date in the manifest, skipped')
+
+    results = []
+
+    def record(result):
+        # the row of a converted paper is appended at once, so that an interrupted batch does not convert it again
+        archive_path, success, error, seconds = result
+        row = get_result_row(archive_rows[archive_path], converter_version, output_dir, success, error, seconds)
+        manifest[row['arxiv_id']] = row
+        append_manifest(output_dir, row)
+        results.append(result)
+
+    for result in unreadable:
+        record(result)
+    if jobs == 1 and timeout is None and memory_limit is None:
+        for archive_path, paper_id, output_base, archive_format in tasks:
+            print(f'processing {archive_path} ({archive_format}) -> {paper_id}')
+            time_start = time.monotonic()
+            result = process_archive(archive_path, paper_id, output_base, archive_format)
+            record((*result, time.monotonic() - time_start))
+    else:
+        for result in schedule_papers(tasks, jobs, timeout, memory_limit):
+            record(result)
+            print(f'[{len(results)}/{len(tasks)}] {"done" if result[1] else "failed"} in {result[3]:.1f}s: {result[0]}')
+    save_manifest(output_dir, manifest)
+
+    failed = [result for result in results if not result[1]]
+    print(f'{len(results) - len(failed)} of {len(results)} papers processed')
+    for archive_format in sorted(set(formats.values())):
+        format_results = [result for result in results if formats[result[0]] == archive_format]
+        n_done = sum(1 for result in format_results if result[1])
+        print(f'  {archive_format}: {len(format_results)} papers, {n_done} processed')
+    for archive_path, _, error, _ in failed:
+        print(f'failed: {archive_path}' + (f' ({error})' if error else ''))
+    if results:
+        seconds = [result[3] for result in results]
+        print(f'time per paper: p50 {percentile(seconds, 50):.1f}s, p95 {percentile(seconds, 95):.1f}s, '
+              f'p99 {percentile(seconds, 99):.1f}s, max {max(seconds):.1f}s')
+    return results
 
 
 
 if __name__ == '__main__':
-    batch_process_latex()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Convert the LaTeX sources of a directory of arXiv archives to text')
+    parser.add_argument('root_dir', nargs='?', default='downloads/cvpr2022')
+    parser.add_argument('output_dir', nargs='?', default='processed')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of papers converted in parallel, 0 for the number of cores')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which a paper is killed')
+    parser.add_argument('--memory-limit', type=int, default=None, help='MB of address space for each paper')
+    parser.add_argument('--force', action='store_true', help='convert all the papers, even those up to date')
+    args = parser.parse_args()
+    memory_limit = args.memory_limit * 1024 * 1024 if args.memory_limit else None
+    batch_process_latex(args.root_dir, args.output_dir, args.jobs or os.cpu_count(), args.timeout, memory_limit,
+                        args.force)
@@ -0,0 +1,69 @@
+"""
+Time of connect_paragraphs and split_too_long_paragraphs of text_process against the number of lines and of
+sentences, with the quadratic versions they replaced, from tests/test_text_process.py, for reference.
+
+    python latex2txt/benchmarks/bench_text_process.py --lines 1000 10000 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+import text_process
+from test_text_process import connect_paragraphs_old, split_too_long_paragraphs_old
+
+words = 'the model we propose a network for segmentation results show that our method outperforms'.split()
+
+
+def lines_text(n, seed=0):
+    # n lines, most of them continued by the next one, as the lines of a wrapped paragraph
+    r = random.Random(seed)
+    return '\n'.join(' '.join(r.choice(words) for _ in range(8)) + ('.' if r.random() < 0.1 else '')
+                     for _ in range(n))
+
+
+def long_paragraph(n, seed=0):
+    # one line of n capitalized sentences
+    r = random.Random(seed)
+    return '.'.join(' ' + ' '.join(r.choice(words) for _ in range(8)).capitalize() for _ in range(n)) + '.'
+
+
+def best(function, *args, repeat=3):
+    # (best seconds, result)
+    times = []
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - time_start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark connect_paragraphs and split_too_long_paragraphs')
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--old-limit', type=int, default=20000, help='larger inputs are not run with the old code')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    sys.setrecursionlimit(100000)
+    for n in args.lines:
+        text = lines_text(n)
+        seconds, result = best(text_process.connect_paragraphs, text, repeat=args.repeat)
+        line = f'connect_paragraphs, {n} lines: {seconds:.3f}s'
+        if n <= args.old_limit:
+            seconds_old, result_old = best(connect_paragraphs_old, text, repeat=args.repeat)
+            assert result == result_old
+            line += f', old {seconds_old:.3f}s'
+        print(line)
+    for n in args.lines:
+        paragraph = long_paragraph(n)
+        seconds, result = best(text_process.split_too_long_paragraphs, paragraph, repeat=args.repeat)
+        line = f'split_too_long_paragraphs, {n} sentences: {seconds:.3f}s'
+        if n <= args.old_limit:
+            seconds_old, result_old = best(split_too_long_paragraphs_old, paragraph, text_process.char_limit,
+                                           repeat=args.repeat)
+            assert result == result_old
+            line += f', old {seconds_old:.3f}s'
+        print(line)
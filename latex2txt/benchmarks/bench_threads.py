@@ -0,0 +1,103 @@
+"""
+Time of LatexTranslator.translate_full_latex against the number of paragraph threads, on a generated math-heavy
+document. The paragraphs are split with the document tree on the calling thread, and the objects are replaced in
+the threads, where the regex module releases the GIL (concurrent=True). The speedup needs as many cores as threads.
+
+    python latex2txt/benchmarks/bench_threads.py --size 400 --threads 1 2 4 8
+"""
+import os
+import io
+import sys
+import time
+import random
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import translatex
+
+words = ('the of model we propose a novel network for image segmentation with attention layer results show '
+         'that our method outperforms prior work on benchmark datasets').split()
+inline_math = [r'$x_{%d} + \alpha_{i}^{2}$', r'$\frac{\partial L}{\partial w_{%d}}$', r'\(\sum_{k=1}^{%d} k\)',
+               r'$\mathcal{O}(n^{%d})$', r'$\{a_i\}_{i=1}^{%d}$']
+display_math = [r'\begin{equation}\label{eq:%d} L = \sum_{i} \left\| f(x_i) - y_i \right\|^2 \end{equation}',
+                r'\[ \int_0^{%d} e^{-t^2} \, dt = \frac{\sqrt{\pi}}{2} \]',
+                r'\begin{align} a &= b + c_{%d} \\ d &= \frac{e}{f} \end{align}',
+                r'$$ \prod_{j=1}^{%d} (1 + x_j) $$']
+
+
+def paragraph(r):
+    pieces = []
+    for _ in range(r.randint(20, 60)):
+        c = r.random()
+        if c < 0.3:
+            pieces.append(r.choice(inline_math) % r.randint(1, 99))
+        elif c < 0.4:
+            pieces.append(r'\textbf{%s} \cite{ref%d}' % (r.choice(words), r.randint(1, 99)))
+        elif c < 0.45:
+            pieces.append(r'\footnote{%s}' % ' '.join(r.choice(words) for _ in range(5)))
+        else:
+            pieces.append(' '.join(r.choice(words) for _ in range(r.randint(1, 6))))
+    return ' '.join(pieces) + '.'
+
+
+def document(size, seed=0):
+    # about size bytes of paragraphs, sections and display math
+    r = random.Random(seed)
+    blocks = []
+    total = 0
+    while total < size:
+        c = r.random()
+        if c < 0.1:
+            block = r'\section{%s}' % ' '.join(r.choice(words) for _ in range(3))
+        elif c < 0.4:
+            block = r.choice(display_math) % r.randint(1, 99)
+        else:
+            block = paragraph(r)
+        blocks.append(block)
+        total += len(block) + 2
+    return ('\\documentclass{article}\n\\usepackage{amsmath}\n\\begin{document}\n' + '\n\n'.join(blocks) +
+            '\n\\end{document}\n')
+
+
+def run(latex, threads, concurrent=None, repeat=3):
+    # (best seconds of the whole conversion, seconds of the paragraph split of the best run, output)
+    best = None
+    for _ in range(repeat):
+        translator = translatex.LatexTranslator(threads=threads, concurrent=concurrent)
+        split = translator.split_latex_to_paragraphs
+        time_split = 0.0
+
+        def timed_split(latex):
+            nonlocal time_split
+            time_start = time.perf_counter()
+            paragraphs = split(latex)
+            time_split = time.perf_counter() - time_start
+            return paragraphs
+
+        translator.split_latex_to_paragraphs = timed_split
+        time_start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            output = translator.translate_full_latex(latex, nocache=True)
+        seconds = time.perf_counter() - time_start
+        if best is None or seconds < best[0]:
+            best = (seconds, time_split, output)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the paragraph threads of LatexTranslator')
+    parser.add_argument('--size', type=int, default=400, help='KB of LaTeX')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    latex = document(args.size * 1024)
+    print(f'{len(latex)} characters, {os.cpu_count()} cores, GIL enabled: {translatex.is_gil_enabled()}')
+    reference = None
+    for threads in args.threads:
+        seconds, time_split, output = run(latex, threads, repeat=args.repeat)
+        if reference is None:
+            reference = (seconds, output)
+        assert output == reference[1], f'the output with {threads} threads differs'
+        print(f'threads {threads}: {seconds:.3f}s, split {time_split:.3f}s on the calling thread, '
+              f'speedup {reference[0] / seconds:.2f}')
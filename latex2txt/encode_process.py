@@ -1,5 +1,11 @@
+import io
+import locale
+import hashlib
 import charset_normalizer
 force_utf8 = False
+detect_sample_size = 64 * 1024  # bytes given to charset_normalizer when the file is not UTF-8
+max_encoding_cache = 4096
+encoding_cache = {}  # sha1 of the content: detected encoding
 
 
 def get_file_encoding(filename):
@@ -16,8 +22,68 @@ def get_file_encoding(filename):
     else:
         with open(filename, "rb") as f:
             data = f.read()
+        return get_data_encoding(data, filename)
+
+
+def get_data_encoding(data, filename):
+    """
+    Same as get_file_encoding, for the content of the file which is already read.
+    Valid UTF-8 (so ASCII too) is accepted without detection, otherwise charset_normalizer is run on
+    the first detect_sample_size bytes, and its result is cached by the hash of the content.
+
+    :param data: The bytes of the file
+    :param filename: A string representing the path of the file, for the warning
+    :return: A string representing the encoding of the file
+    """
+    if force_utf8:
+        return 'utf-8'
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    else:
+        return 'utf-8-sig' if data.startswith(b'\xef\xbb\xbf') else 'utf-8'
+    key = hashlib.sha1(data).digest()
+    if key in encoding_cache:
+        return encoding_cache[key]
+    sample = data[:detect_sample_size]
+    result = charset_normalizer.detect(sample)
+    current_encoding = result["encoding"]
+    if len(sample) < len(data) and current_encoding is not None:
+        # the sample may look fine in an encoding which fails on the rest, then the whole file is detected
+        try:
+            data.decode(current_encoding)
+        except (UnicodeDecodeError, LookupError):
             result = charset_normalizer.detect(data)
             current_encoding = result["encoding"]
-            if result['confidence'] < 0.9:
-                print(f'file {filename} may have wrong encoding')
-        return current_encoding
+    if result['confidence'] is None or result['confidence'] < 0.9:
+        print(f'file {filename} may have wrong encoding')
+    if len(encoding_cache) >= max_encoding_cache:
+        encoding_cache.clear()
+    encoding_cache[key] = current_encoding
+    return current_encoding
+
+
+def decode_data(data, filename):
+    """
+    Decodes the content of a file which is already read, with the encoding of get_data_encoding.
+    Gives the same text as open(filename, encoding=...).read(), universal newlines included.
+
+    :param data: The bytes of the file
+    :param filename: A string representing the path of the file, for the warning
+    :return: The text of the file
+    """
+    encoding = get_data_encoding(data, filename) or locale.getpreferredencoding(False)
+    return io.StringIO(data.decode(encoding), newline=None).read()
+
+
+def read_file(filename):
+    """
+    Reads a file once and decodes it with decode_data.
+
+    :param filename: A string representing the path of the file to be read
+    :return: The text of the file
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    return decode_data(data, filename)
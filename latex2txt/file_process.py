@@ -1,7 +1,8 @@
 import os
 import re
 from .latex_process import remove_tex_comments
-from .encode_process import get_file_encoding
+from .encode_process import get_data_encoding, read_file
+from .source_process import SourceTree, DirectorySources, pattern_input
 
 
 def merge_complete(tex):
@@ -10,25 +11,14 @@ def merge_complete(tex):
     '''
     path = f'{tex}.tex'
     dirname = os.path.dirname(path)
-    encoding = get_file_encoding(path)
-    content = open(path, encoding=encoding).read()
-    content = remove_tex_comments(content)
-    pattern_input = re.compile(r'\\input{(.*?)}')
-    while True:
-        result = pattern_input.search(content)
-        if result is None:
-            break
-        begin, end = result.span()
-        match = result.group(1)
-        filename = os.path.join(dirname, match)
-        if os.path.exists(f'{filename}.tex'):
-            filename = f'{filename}.tex'
-        print('merging', filename)
-        assert os.path.exists(filename)
-        encoding = get_file_encoding(filename)
-        new_content = open(filename, encoding=encoding).read()
-        new_content = remove_tex_comments(new_content)
-        content = content[:begin] + new_content + content[end:]
+    # each file is read, decoded and scanned for \input once, the comments are removed first
+    tree = SourceTree(DirectorySources(dirname), get_encoding=get_data_encoding, pattern=pattern_input,
+                      preprocess=remove_tex_comments)
+    name = os.path.basename(path)
+    content = tree.resolve(name, once=False)
+    for sub_name in tree.byte_counts:
+        if sub_name != name:
+            print('merging', os.path.join(dirname, sub_name))
     print(content, file=open(path, "w", encoding='utf-8'))
 
 
@@ -38,10 +28,8 @@ def add_bbl(tex):
     '''
     path_tex = f'{tex}.tex'
     path_bbl = f'{tex}.bbl'
-    encoding = get_file_encoding(path_tex)
-    content = open(path_tex, encoding=encoding).read()
-    encoding = get_file_encoding(path_bbl)
-    bbl = open(path_bbl, encoding=encoding).read()
+    content = read_file(path_tex)
+    bbl = read_file(path_bbl)
     patterns = [r'\\bibliography\{(.*?)\}', r'\\thebibliography\{(.*?)\}']
     for pattern in patterns:
         pattern_input = re.compile(pattern, re.DOTALL)
@@ -1,6 +1,9 @@
 import re
 import regex
 import os
+import functools
+import collections
+import time
 
 math_code = 'XMATHX'
 mularg_command_list = [('textcolor', 2, (1, ))]
@@ -67,6 +70,10 @@ special_character_forward = {
     '@': 'AT',
 }
 special_character_backward = {special_character_forward[key]: key for key in special_character_forward}
+pattern_recover_special = re.compile(
+    math_code + '(' + '|'.join(special_character_forward[special] for special in list_special) + ')')
+pattern_accent_and_special = re.compile(  # group 1-3: as pattern_accent, group 4: special character
+    pattern_accent + r"|\\(\\(?![`'\"^=.](?:\{[a-zA-Z]\}|[a-zA-Z]))|[%&#${} ])")
 assert len(set(special_character_forward.values())) == len(special_character_forward)
 
 environment_list = ['abstract', 'acknowledgments', 'itemize', 'enumerate', 'description', 'list', 'proof', 'quote', 'spacing']
@@ -74,6 +81,62 @@ command_list = ['section', 'subsection', 'subsubsection', 'caption', 'subcaption
 format_list = ['textbf', 'textit', 'emph']
 replace_newcommand_list = ['equation', 'array', 'displaymath', 'align', 'multiple', 'gather', 'theorem', 'textcolor'] + environment_list + command_list
 
+# compiled patterns of LaTeX objects for replace_latex_objects, in the order they are removed
+latex_obj_patterns = [regex.compile(pattern, regex.DOTALL) for pattern in [
+    r"\$\$(.*?)\$\$",  # $$ $$
+    r"\$(.*?)\$",  # $ $
+    r"\\\[(.*?)\\\]",  # \[ xxx \]
+    r"\\\((.*?)\\\)",  # \( xxx \)
+    pattern_env,  # \begin{xxx} \end{xxx}
+    pattern_set1,
+    pattern_set2,
+] + [get_pattern_command_full(name, n) for name, n, index in mularg_command_list] + [pattern_command_full]]  # \xxx[xxx]{xxx}
+latex_obj_pattern_brace = regex.compile(pattern_brace, regex.DOTALL)
+latex_obj_pattern_command_simple = regex.compile(pattern_command_simple, regex.DOTALL)
+pattern_replaced_obj = re.compile(rf"{math_code}_(\d+(?:_\d+)*)")  # group 1: digits of the index
+# the codes of replaced objects, and the "_" which modify_after escapes in the text around them
+pattern_recover = re.compile(rf"{math_code}_(\d+(?:_\d+)*)|(?<!\\)_")
+compiled_pattern_newcommand = regex.compile(pattern_newcommand, regex.DOTALL)
+pattern_used_command = re.compile(r'\\([a-zA-Z]+)')  # group 1: name, a trailing * is not part of it
+pattern_used_env = re.compile(rf'\\begin{spaces}\{{([^{{}}]*?)\*?\}}')  # group 1: name without *
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_pattern_command_full(name, n=None):
+    # registry of the compiled get_pattern_command_full patterns, each one is built and compiled once
+    return regex.compile(get_pattern_command_full(name, n), regex.DOTALL)
+
+
+class UsedNames:
+    # names of the commands and environments used in a document, found with one scan,
+    # so that the passes for names which do not appear are skipped. Counts the passes run and skipped
+
+    def __init__(self, latex):
+        self.commands = collections.Counter()
+        self.environments = set()
+        self.passes_run = 0
+        self.passes_skipped = 0
+        self.add(latex)
+
+    def add(self, latex):
+        # add the names used in `latex`, e.g. in the content of an expanded \newcommand
+        self.commands.update(pattern_used_command.findall(latex))
+        self.environments.update(pattern_used_env.findall(latex))
+
+    def need_pass(self, used):
+        if used:
+            self.passes_run += 1
+        else:
+            self.passes_skipped += 1
+        return used
+
+    def has_command(self, name, count=1):
+        # names may be given as patterns like `section\*`
+        return self.need_pass(self.commands[name.replace(r'\*', '').rstrip('*')] >= count)
+
+    def has_environment(self, name):
+        return self.need_pass(name.replace(r'\*', '').rstrip('*') in self.environments)
+
 
 def variable_code(count):
     # If count is 123, the code is {math_code}_1_2_3
@@ -107,75 +170,188 @@ def modify_after(text):
     return text
 
 
-def replace_latex_objects(text, brace=True, command_simple=True):
+def get_timeout(deadline):
+    # seconds left for a regex call before `deadline` (of time.monotonic), None for no limit
+    if deadline is None:
+        return None
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        raise TimeoutError
+    return timeout
+
+
+def record_timeout(records, function_name, pattern, text, time_start):
+    # structured record, added to `records`, of a call which ran out of its timeout and used the fallback
+    records.append({
+        'function': function_name,
+        'pattern': pattern.pattern,
+        'length': len(text),
+        'paragraph': text[:200],
+        'time': time.monotonic() - time_start,
+    })
+
+
+def remove_latex_objects(text, pattern, replaced_objs, deadline=None, concurrent=None):
+    # same as replacing the leftmost match of `pattern` by ' ' until there is none, but in one left-to-right scan.
+    # Removing an object can only let an earlier position match if a partial match ends right before it,
+    # e.g. \foo\bar{x}{y} -> \foo {y}, and only then the rest of the text is rebuilt and scanned from there.
+    # Removing the next object may in turn let a position before the partial match match, if a partial match
+    # ends right before that one, e.g. \foo\bar\baz{x}{y}{z} -> \foo\bar {y}{z} -> \foo {z}, so the text is
+    # rebuilt from the first partial match of the chain, or from `start` for a long chain.
+    # The text before `start` never changes, as no partial match reached the object removed there.
+    # With concurrent=True, the regex module releases the GIL while it is matching
+    pieces = []
+    start = 0
+    while True:
+        match = pattern.search(text, start, concurrent=concurrent, timeout=get_timeout(deadline))
+        if match is None:
+            break
+        replaced_objs.append(match.group())
+        begin, end = match.span()
+        cut = begin
+        for _ in range(10):
+            partial = pattern.search(text, start, cut, concurrent=concurrent, partial=True,
+                                     timeout=get_timeout(deadline))
+            if partial is None or partial.start() == cut:
+                break
+            cut = partial.start()
+        else:
+            cut = start
+        if cut == begin:
+            pieces.append(text[start:begin] + ' ')
+            start = end
+        else:
+            pieces.append(text[start:cut])
+            text = text[cut:begin] + ' ' + text[end:]
+            start = 0
+    pieces.append(text[start:])
+    return ''.join(pieces)
+
+
+def remove_latex_objects_tree(text, brace=True, command_simple=True):
+    # the cheaper strategy of replace_latex_objects for the text which runs out of its timeout:
+    # the outermost objects of the document tree are replaced by ' ', without any recursive pattern
+    root = parse_latex_tree(text)
+    replaced_objs = []
+
+    def rewrite(node):
+        if node.kind == 'group' and not brace:
+            return None
+        if node.kind == 'command' and not command_simple and node.end == node.start + len(node.name) + 1:
+            return None
+        replaced_objs.append(text[node.start:node.end])
+        return ' '
+
+    return rewrite_latex_tree(text, root, rewrite), replaced_objs
+
+
+def replace_latex_objects(text, brace=True, command_simple=True, timeout=None, concurrent=None, records=None):
     r"""
-    Replaces all LaTeX objects in a given text with the format "{math_code}_{digit1}_{digit2}_..._{digit_last}",
-    applies a given function to the resulting text (excluding the "{math_code}_{digit1}_{digit2}_..._{digit_last}" parts),
+    Replaces all LaTeX objects in a given text with a single space,
+    applies a given function to the resulting text,
     and returns both the processed text and a list of replaced LaTeX objects.
     Supported LaTeX objects: \[ xxx \], \begin{xxx} \end{xxx}, $$ $$,
     $ $, \( xxx \), \xxx[xxx]{xxx}, \xxx{xxx}, and \xxx.
+    If the regex matching takes more than `timeout` seconds (None for no limit),
+    the objects are found with the document tree instead and the call is added to the list `records`, if given.
+    With concurrent=True, the GIL is released during the matching, for the threads of LatexTranslator.
     Returns the processed text and a list of replaced LaTeX objects.
     """
 
     # You need to make sure that the input does not contain {math_code}
-    # define regular expressions for each LaTeX object
-    patterns_mularg_command = [get_pattern_command_full(name, n) for name, n, index in mularg_command_list]
-    latex_obj_regex = [
-        r"\$\$(.*?)\$\$",  # $$ $$
-        r"\$(.*?)\$",  # $ $
-        r"\\\[(.*?)\\\]",  # \[ xxx \]
-        r"\\\((.*?)\\\)",  # \( xxx \)
-        pattern_env,  # \begin{xxx} \end{xxx}
-        pattern_set1,
-        pattern_set2,
-    ] + patterns_mularg_command + [pattern_command_full]  # \xxx[xxx]{xxx}
+    patterns = list(latex_obj_patterns)
     if brace:
-        latex_obj_regex.append(pattern_brace)
+        patterns.append(latex_obj_pattern_brace)
     if command_simple:
-        latex_obj_regex.append(pattern_command_simple)  # \xxx
+        patterns.append(latex_obj_pattern_command_simple)  # \xxx
 
-    # iterate through each LaTeX object and replace with "{math_code}_{digit1}_{digit2}_..._{digit_last}"
-    count = 0
+    time_start = time.monotonic()
+    deadline = None if timeout is None else time_start + timeout
     replaced_objs = []
-    for regex_symbol in latex_obj_regex:
-        pattern = regex.compile(regex_symbol, regex.DOTALL)
-        while pattern.search(text):
-            latex_obj = pattern.search(text).group()
-            replaced_objs.append(latex_obj)
-            text = pattern.sub(' ', text, 1)
+    latex = text
+    try:
+        for pattern in patterns:
+            text = remove_latex_objects(text, pattern, replaced_objs, deadline, concurrent)
+    except TimeoutError:
+        if records is not None:
+            record_timeout(records, 'replace_latex_objects', pattern, latex, time_start)
+        text, replaced_objs = remove_latex_objects_tree(latex, brace, command_simple)
 
     text = modify_text(text, modify_before)
     return text, replaced_objs
 
 
 def recover_latex_objects(text, replaced_objs, tolerate_error=False):
-    # recover the latex objects from "replace_latex_objects"
+    # recover the latex objects from "replace_latex_objects" with one scan of the text.
+    # Objects may contain the codes of other objects, so each object is recovered once,
+    # from the inside out, and kept in `recovered`
     nobjs = len(replaced_objs)
-    matched_indices = []
-
-    def get_obj(digit_str):
-        index = int(''.join(digit_str.split('_')))
-        matched_indices.append(index)
-        if index < nobjs:
-            return replaced_objs[index]
-
-
-    text = modify_text(text, modify_after)
-    pattern = re.compile(match_code_replace)
+    recovered = {}  # index: (recovered object, number of codes matched, set of indices matched)
+    recovering = set()
+
+    def recover(text, pattern):
+        n_matched = 0
+        indices = set()
+
+        def replace_function(match):
+            nonlocal n_matched
+            if match.group(1) is None:
+                return r'\_'
+            index = int(''.join(match.group(1).split('_')))
+            if index < nobjs and index not in recovered and index not in recovering:
+                recover_obj(index)
+            n_matched += 1
+            indices.add(index)
+            if index in recovered:
+                obj, n, obj_indices = recovered[index]
+                n_matched += n
+                indices.update(obj_indices)
+                return obj
+            # an object which contains itself is kept as a code
+            return match.group() if index < nobjs else ''
+
+        return pattern.sub(replace_function, text), n_matched, indices
+
+    def recover_obj(index):
+        stack = [index]
+        while stack:
+            i = stack[-1]
+            if i in recovered:
+                stack.pop()
+                continue
+            pending = [int(''.join(digit_str.split('_'))) for digit_str in pattern_replaced_obj.findall(replaced_objs[i])]
+            pending = [j for j in pending if j < nobjs and j not in recovered and j not in recovering]
+            if pending:
+                recovering.add(i)
+                stack.extend(pending)
+                continue
+            recovered[i] = recover(replaced_objs[i], pattern_replaced_obj)
+            recovering.discard(i)
+            stack.pop()
+
+    text, total_num, matched_indices = recover(text, pattern_recover)
     # count number of mismatch
-    total_num = 0
-    while True:
-        text, num_modify = pattern.subn(lambda match: get_obj(match.group(1)), text)
-        total_num += num_modify
-        if num_modify == 0:
-            break
-    n_good = len(set(matched_indices).intersection(set(range(nobjs))))
-    n_bad1 = len(matched_indices) - n_good
+    n_good = len(matched_indices.intersection(range(nobjs)))
+    n_bad1 = total_num - n_good
     n_bad2 = nobjs - n_good
     n_bad = max(n_bad1, n_bad2)
     return text, n_bad, nobjs
 
 
+pattern_comment_tokens = r"\\%|\n\s*%.*?(?=\n)|%.*?(?=\n)"  # \% is kept, the rest are comments
+pattern_remove_comments = re.compile(r"\\\\|" + pattern_comment_tokens)  # \\ is kept
+pattern_preprocess = re.compile(r"\\mathbf|\\\\(?!mathbf)|" + pattern_comment_tokens)
+
+
+def preprocess_function(match):
+    token = match.group()
+    if token == r'\mathbf':
+        return r'\boldsymbol'
+    if token[0] == '\\':
+        return token
+    return ''
+
+
 def remove_tex_comments(text):
     """
     Removes all TeX comments in a given string with the format "% comment text".
@@ -183,14 +359,19 @@ def remove_tex_comments(text):
     If "%" is at the beginning of a line then delete this line.
     Returns the processed string.
     """
-    text = text.replace(r'\\', f'{math_code}_BLACKSLASH')
-    text = text.replace(r'\%', f'{math_code}_PERCENT')
-    text = re.sub(r"\n\s*%.*?(?=\n)", "", text)
-    text = re.sub(r"%.*?(?=\n)", "", text)
-    text = text.replace(f'{math_code}_PERCENT', r'\%')
-    text = text.replace(f'{math_code}_BLACKSLASH', r'\\')
+    return pattern_remove_comments.sub(preprocess_function, text)
 
-    return text
+
+def preprocess_latex(latex):
+    r"""
+    Same as remove_tex_comments, replacing \mathbf by \boldsymbol and remove_bibnote one after the other,
+    but the comments and \mathbf are handled in one scan, and remove_bibnote only runs if there is a \bibinfo.
+    Returns the processed string.
+    """
+    latex = pattern_preprocess.sub(preprocess_function, latex)
+    if r'\bibinfo' in latex:
+        latex = remove_bibnote(latex)
+    return latex
 
 
 def split_latex_document(text, begin_code, end_code):
@@ -208,27 +389,12 @@ def split_latex_document(text, begin_code, end_code):
     return body, pre, post
 
 
-def process_specific_env(latex, function, env_name):
-    # find all patterns of \begin{env_name}[options] content \end{env_name}
-    # then replace `content` by `function(content)`
-    pattern = regex.compile(get_pattern_env(env_name), regex.DOTALL)
-
-    def process_function(match):
-        name = match.group(1)
-        assert re.match(env_name, name)
-        options = match.group(2)
-        if options is None:
-            options = ''
-        content = match.group(3)
-        processed_content = function(content)
-        return rf'\begin{{{env_name}}}{options}{processed_content}\end{{{env_name}}}'
-    return pattern.sub(process_function, latex)
-
-
-def process_specific_command(latex, function, command_name):
+def process_specific_command(latex, function, command_name, used_names=None):
     # find all patterns of # \{command_name}[options]{content}
     # then replace `content` by `function(content)`
-    pattern = regex.compile(get_pattern_command_full(command_name), regex.DOTALL)
+    if used_names is not None and not used_names.has_command(command_name):
+        return latex
+    pattern = compile_pattern_command_full(command_name)
 
     def process_function(match):
         name = match.group(1)
@@ -242,11 +408,13 @@ def process_specific_command(latex, function, command_name):
     return pattern.sub(process_function, latex)
 
 
-def process_mularg_command(latex, function, command_tuple):
+def process_mularg_command(latex, function, command_tuple, used_names=None):
     # find all patterns of # \{command_name}[options]{content}
     # then replace `content` by `function(content)`
     command_name, nargs, args_to_translate = command_tuple
-    pattern = regex.compile(get_pattern_command_full(command_name, n=nargs), regex.DOTALL)
+    if used_names is not None and not used_names.has_command(command_name):
+        return latex
+    pattern = compile_pattern_command_full(command_name, nargs)
 
     def process_function(match):
         name = match.group(1)
@@ -263,29 +431,307 @@ def process_mularg_command(latex, function, command_tuple):
     return pattern.sub(process_function, latex)
 
 
+class LatexNode:
+    # a node of the document tree built by parse_latex_tree
+    # kind is 'root', 'math', 'env', 'command' or 'group'; text is not stored as nodes, it is the gaps between the children
+    # [start, end) is the span of the whole node, [content_start, content_end) the span of the content of an env or group
+    # children are the nodes inside the content of an env or group, and the argument groups of a command
+
+    def __init__(self, kind, start, end=None, name=None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.name = name
+        self.options = ''
+        self.nargs = 0
+        self.content_start = start
+        self.content_end = end
+        self.children = []
+
+
+tree_special = re.compile(r'[\\${}]')
+tree_command_name = re.compile(r'\\([a-zA-Z]+\*?)')
+tree_env_begin = regex.compile(rf'\\begin{spaces}\{{([^{{}}]*)\}}{spaces}({options})?')
+tree_env_end = regex.compile(rf'\\end{spaces}\{{([^{{}}]*)\}}')
+tree_command_arg = regex.compile(rf'{spaces}({options})?{spaces}\{{')
+tree_mularg_arg = regex.compile(rf'{spaces}\{{')
+tree_command_set = [regex.compile(pattern, regex.DOTALL) for pattern in [pattern_set1, pattern_set2]]
+tree_math_delimiters = [('$$', '$$'), ('$', '$'), ('\\[', '\\]'), ('\\(', '\\)')]
+mularg_command_nargs = {name: n for name, n, index in mularg_command_list}
+
+
+def drop_unclosed(latex, stack, depth):
+    # the nodes in stack[depth:] are never closed: their beginning is kept as text
+    # (or as a command without this argument) and their children are moved to the parent
+    while len(stack) > depth:
+        node = stack.pop()
+        parent = stack[-1]
+        if node.kind == 'group' and parent.kind == 'command':
+            parent.children.pop()
+            if parent.children:
+                parent.end = parent.children[-1].end
+            else:
+                parent.end = parent.start + len(parent.name) + 1
+                parent.options = ''
+            stack.pop()
+            parent = stack[-1]
+        elif node.kind == 'group':
+            parent.children.pop()
+        else:
+            # \begin{xxx} alone is a command with one argument
+            node.kind = 'command'
+            node.name = 'begin'
+            node.end = latex.index('}', node.start) + 1
+            node.options = ''
+            node.children, children = [], node.children
+            parent.children.extend(children)
+            continue
+        parent.children.extend(node.children)
+
+
+def parse_latex_tree(latex):
+    r"""
+    Parses a LaTeX string into a tree of LatexNode in one left-to-right scan, so that the transforms of
+    environments, commands and braces walk the tree instead of running one regex pass per name.
+    Objects are recognised as in replace_latex_objects: math ($$ $$, $ $, \[ \], \( \)) is opaque,
+    \begin{xxx}[xxx] ... \end{xxx} is an env, \xxx[xxx]{xxx} is a command with one argument
+    (more for mularg_command_list), \xxx is a command without arguments and {xxx} is a group.
+    Returns the root node.
+    """
+    root = LatexNode('root', 0, len(latex))
+    stack = [root]
+
+    def open_group(parent, start):
+        group = LatexNode('group', start)
+        group.content_start = start + 1
+        parent.children.append(group)
+        stack.append(group)
+
+    env_ends = {}  # env: position of the first \end{name} of its name found after it, -1 if there is none
+
+    def is_closed_after(env, pos):
+        end = env_ends.get(env)
+        if end is None or end != -1 and end < pos:
+            match = re.compile(rf'\\end{spaces}\{{{re.escape(env.name)}\}}').search(latex, pos)
+            end = env_ends[env] = match.start() if match is not None else -1
+        return end != -1
+
+    pos = 0
+    while True:
+        match = tree_special.search(latex, pos)
+        if match is None:
+            break
+        pos = match.start()
+        top = stack[-1]
+
+        math_end = -1
+        for begin_code, end_code in tree_math_delimiters:
+            if latex.startswith(begin_code, pos):
+                math_end = latex.find(end_code, pos + len(begin_code))
+                if math_end != -1:
+                    math_end += len(end_code)
+                    break
+        if math_end != -1:
+            top.children.append(LatexNode('math', pos, math_end))
+            pos = math_end
+        elif latex[pos] == '{':
+            open_group(top, pos)
+            pos += 1
+        elif latex[pos] == '}':
+            pos += 1
+            if top.kind == 'env':
+                # like the brace pattern once the envs are removed, the group is closed if the envs opened in it
+                # are never closed
+                depth = next(i for i in range(len(stack) - 1, -1, -1) if stack[i].kind != 'env')
+                if stack[depth].kind == 'group' and not any(is_closed_after(env, pos) for env in stack[depth + 1:]):
+                    drop_unclosed(latex, stack, depth + 1)
+                    top = stack[-1]
+            if top.kind != 'group':
+                continue
+            stack.pop()
+            top.end = pos
+            top.content_end = pos - 1
+            command = stack[-1]
+            if command.kind == 'command':
+                # the group is an argument, the command is finished unless it takes another one
+                arg = tree_mularg_arg.match(latex, pos)
+                if len(command.children) < command.nargs and arg is not None:
+                    open_group(command, arg.end() - 1)
+                    pos = arg.end()
+                else:
+                    stack.pop()
+                    command.end = pos
+        elif latex[pos] == '$':
+            pos += 1
+        else:
+            name_match = tree_command_name.match(latex, pos)
+            if name_match is None:
+                # \ followed by a non-letter, the next character is parsed as usual
+                pos += 1
+                continue
+            name = name_match.group(1)
+            begin = tree_env_begin.match(latex, pos) if name == 'begin' else None
+            end = tree_env_end.match(latex, pos) if name == 'end' else None
+            env_depth = None
+            if end is not None:
+                env_depth = next((i for i in range(len(stack) - 1, 0, -1)
+                                  if stack[i].kind == 'env' and stack[i].name == end.group(1)), None)
+            command_set = None
+            if name.startswith('set'):
+                command_set = next((m for m in (p.match(latex, pos) for p in tree_command_set) if m), None)
+            if begin is not None:
+                env = LatexNode('env', pos, name=begin.group(1))
+                env.options = begin.group(2) or ''
+                env.content_start = begin.end()
+                top.children.append(env)
+                stack.append(env)
+                pos = begin.end()
+            elif env_depth is not None:
+                # like the lazy pattern_env, \end{xxx} closes the env even if braces inside are not balanced
+                drop_unclosed(latex, stack, env_depth + 1)
+                top = stack.pop()
+                top.end = end.end()
+                top.content_end = pos
+                pos = end.end()
+            elif command_set is not None:
+                top.children.append(LatexNode('command', pos, command_set.end(), name))
+                pos = command_set.end()
+            else:
+                command = LatexNode('command', pos, name_match.end(), name)
+                top.children.append(command)
+                pos = name_match.end()
+                command.nargs = mularg_command_nargs.get(name, 1)
+                arg = tree_mularg_arg.match(latex, pos) if command.nargs > 1 else None
+                if arg is None:
+                    command.nargs = 1
+                    arg = tree_command_arg.match(latex, pos)
+                    if arg is not None:
+                        command.options = arg.group(1) or ''
+                if arg is not None:
+                    stack.append(command)
+                    open_group(command, arg.end() - 1)
+                    pos = arg.end()
+
+    drop_unclosed(latex, stack, 1)
+    return root
+
+
+def rewrite_latex_tree(latex, root, rewrite):
+    # rebuild `latex` from its tree, replacing each outermost node for which `rewrite(node)` is not None.
+    # With a node of the tree as root, the content of that node is rebuilt
+    pieces = []
+    pos = root.content_start
+    nodes = root.children[::-1]
+    while nodes:
+        node = nodes.pop()
+        replacement = rewrite(node)
+        if replacement is not None:
+            pieces.append(latex[pos:node.start])
+            pieces.append(replacement)
+            pos = node.end
+        elif node.kind != 'math':
+            nodes.extend(node.children[::-1])
+    pieces.append(latex[pos:root.content_end])
+    return ''.join(pieces)
+
+
+pattern_blank_lines = re.compile(r'\n\n+')
+
+
+def split_paragraphs(latex):
+    # split at the blank lines which are outside all the objects of the document tree, so that each paragraph
+    # holds whole objects and replace_latex_objects can be run on the paragraphs separately
+    nodes = parse_latex_tree(latex).children
+    paragraphs = []
+    start = 0
+    i = 0
+    for match in pattern_blank_lines.finditer(latex):
+        while i < len(nodes) and nodes[i].end <= match.start():
+            i += 1
+        if i < len(nodes) and nodes[i].start < match.start():
+            continue
+        paragraphs.append(latex[start:match.start()])
+        start = match.end()
+    paragraphs.append(latex[start:])
+    return paragraphs
+
+
+def process_latex_objects(latex, function, env_names, command_names, mularg_commands=mularg_command_list,
+                          used_names=None):
+    # same as process_specific_command and process_mularg_command for all the names at once, and for environments:
+    # find \begin{env_name}[options] content \end{env_name}, \{command_name}[options]{content} (also starred)
+    # and the arguments to translate of \{command_name}{content1}{content2}, then replace `content` by `function(content)`.
+    # The document is parsed once and only the outermost matching objects are processed
+    if used_names is not None:
+        env_names = [name for name in env_names if used_names.has_environment(name)]
+        command_names = [name for name in command_names if used_names.has_command(name)]
+        mularg_commands = [command for command in mularg_commands if used_names.has_command(command[0])]
+        if not env_names and not command_names and not mularg_commands:
+            return latex
+    root = parse_latex_tree(latex)
+    env_names = set(env_names)
+    command_names = set(command_names)
+    mularg_commands = {name: (nargs, args_to_translate) for name, nargs, args_to_translate in mularg_commands}
+
+    def rewrite_inside(node):
+        return None if node.kind == 'command' and node.name in mularg_commands else rewrite(node)
+
+    def rewrite(node):
+        name = node.name[:-1] if node.name and node.name.endswith('*') else node.name
+        if node.kind == 'env' and name in env_names:
+            processed_content = function(latex[node.content_start:node.content_end])
+            return rf'\begin{{{node.name}}}{node.options}{processed_content}\end{{{node.name}}}'
+        if node.kind == 'command' and name in command_names and len(node.children) == 1:
+            processed_content = function(latex[node.children[0].content_start:node.children[0].content_end])
+            return rf'\{node.name}{node.options}{{{processed_content}}}'
+        if node.kind == 'command' and node.name in mularg_commands:
+            nargs, args_to_translate = mularg_commands[node.name]
+            if len(node.children) == nargs:
+                # the environments and commands inside the arguments which are not translated are still processed
+                contents = [function(latex[arg.content_start:arg.content_end]) if i in args_to_translate else
+                            rewrite_latex_tree(latex, arg, rewrite_inside) for i, arg in enumerate(node.children)]
+                return rf'\{node.name}' + ''.join([rf'{{{content}}}' for content in contents])
+        return None
+
+    return rewrite_latex_tree(latex, root, rewrite)
+
+
 def process_leading_level_brace(latex, function):
     # leading level means that the {xxx} is not inside other objects, i.e. \command{} or \begin{xxx} \end{xxx}
-    # replace `{ content }` by `{ function(content) }`
-    text, envs = replace_latex_objects(latex, brace=False)
-    braces_content = []
-    count = 0
-
-    def process_function(match):
-        nonlocal braces_content, count
-        content = match.group(1)
-        # function here is translate_paragraph_latex, which cannot contain replaced environments
-        processed_content = function(recover_latex_objects(content, envs)[0])
-        result = rf'{{ {processed_content} }}'
-        braces_content.append(result)
-        placeholder = f'BRACE{count}BRACE'
-        count += 1
-        return placeholder
-
-    text = regex.compile(pattern_brace, regex.DOTALL).sub(process_function, text)
-    latex = recover_latex_objects(text, envs)[0]
-    for i in range(count):
-        latex = latex.replace(f'BRACE{i}BRACE', braces_content[i])
-    return latex
+    # replace `{ content }` by `{ function(content) }`, other objects are removed as in replace_latex_objects
+    root = parse_latex_tree(latex)
+
+    def remove_objects(node):
+        # content of the node with all objects but braces replaced by ' '
+        pieces = []
+        pos = node.content_start
+        for child in node.children:
+            pieces.append(latex[pos:child.start])
+            pieces.append('{' + remove_objects(child) + '}' if child.kind == 'group' else ' ')
+            pos = child.end
+        pieces.append(latex[pos:node.content_end])
+        return ''.join(pieces)
+
+    def modify(text):
+        return modify_text(modify_text(text, modify_before), modify_after)
+
+    result = []
+    pieces = []
+    pos = 0
+    for child in root.children:
+        pieces.append(latex[pos:child.start])
+        if child.kind == 'group':
+            result.append(modify(''.join(pieces)))
+            pieces = []
+            # function here is translate_paragraph_latex, which cannot contain replaced environments
+            processed_content = function(modify(remove_objects(child)))
+            result.append(rf'{{ {processed_content} }}')
+        else:
+            pieces.append(' ')
+        pos = child.end
+    pieces.append(latex[pos:])
+    result.append(modify(''.join(pieces)))
+    return ''.join(result)
 
 
 def split_by_command(latex):
@@ -375,10 +821,7 @@ def replace_special(text):
 
 
 def recover_special(text):
-    for special in list_special:
-        text = text.replace(math_code + special_character_forward[special], f'\\{special}')
-
-    return text
+    return pattern_recover_special.sub(lambda match: '\\' + special_character_backward[match.group(1)], text)
 
 
 def replace_accent(text):
@@ -411,6 +854,18 @@ def recover_accent(text):
     return text
 
 
+def replace_accent_and_special(text):
+    # same as replace_accent followed by replace_special, in one scan.
+    # As replace_accent runs first, \\ is not a special if the second \ starts an accent
+    def replace_function(match):
+        special = match.group(4)
+        if special is None:
+            return math_code + special_character_forward[match.group(1)] + get_nonNone(match.group(2), match.group(3))
+        return f' {math_code}{special_character_forward[special]} '
+
+    return pattern_accent_and_special.sub(replace_function, text)
+
+
 def combine_split_to_sentences(text):
     # if two lines are separately by only one \n, in latex they are in the same paragraph so we combine them in the same line
     # However we don't combine them if the second line does not start from normal letters (so usually some latex commands)
@@ -427,14 +882,16 @@ def combine_split_to_sentences(text):
     return pattern.sub(process_function, text)
 
 
-def delete_specific_format(latex, format_name):
-    pattern = regex.compile(get_pattern_command_full(format_name), regex.DOTALL)
+def delete_specific_format(latex, format_name, used_names=None):
+    if used_names is not None and not used_names.has_command(format_name):
+        return latex
+    pattern = compile_pattern_command_full(format_name)
     return pattern.sub(lambda m: ' ' + m.group(4) + ' ', latex)
 
 
 def replace_newcommand(newcommand, latex):
     command_name, n_arguments, content = newcommand
-    pattern = regex.compile(get_pattern_command_full(command_name, n_arguments), regex.DOTALL)
+    pattern = compile_pattern_command_full(command_name, n_arguments)
 
     def replace_function(match):
         this_content = content
@@ -448,39 +905,114 @@ def replace_newcommand(newcommand, latex):
     return pattern.sub(replace_function, latex)
 
 
-def process_newcommands(latex):
-    pattern = regex.compile(pattern_newcommand, regex.DOTALL)
-    count = 0
-    full_newcommands = []
-    matches_all = list(regex.finditer(pattern, latex))
-    for match in matches_all:
-        need_replace = False
-        content_all = match.group(0)
-        for special in replace_newcommand_list:
-            if special in content_all:
-                need_replace = True
-        if not need_replace:
-            continue
-        name1 = match.group(1)
-        name2 = match.group(2)
-        name = get_nonNone(name1, name2)
-        n_arguments = match.group(3)
-        if n_arguments is None:
-            n_arguments = 0
+pattern_macro_argument = regex.compile(rf'{spaces}({get_pattern_brace(1)})', regex.DOTALL)  # group 2: content
+pattern_macro_parameter = re.compile(r'#([1-9])')
+
+
+class MacroExpander:
+    # table of the \newcommand/\def macros to expand, built once from the document,
+    # and expanded with one scan which looks up each command name in the table.
+    # Counts the expansions and the time taken
+
+    def __init__(self, latex, used_names=None, max_depth=10):
+        self.latex = latex
+        self.used_names = used_names
+        self.max_depth = max_depth
+        self.macros = {}  # name: (n_arguments, content)
+        self.definitions = []  # (start, end) of the definitions, which are kept as they are
+        self.expansions = 0
+        self.depth_exceeded = 0
+        self.time = 0
+        for match in compiled_pattern_newcommand.finditer(latex):
+            content_all = match.group(0)
+            if not any(special in content_all for special in replace_newcommand_list):
+                continue
+            self.definitions.append(match.span())
+            name = get_nonNone(match.group(1), match.group(2))
+            # the definition itself is one occurrence of the name
+            if name in self.macros or (used_names is not None and not used_names.has_command(name, count=2)):
+                continue
+            n_arguments = match.group(3)
+            n_arguments = 0 if n_arguments is None else int(n_arguments)
+            self.macros[name] = (n_arguments, match.group(5))
+
+    def expand_macro(self, latex, match, depth):
+        # returns the expansion of the command in `match` and the end of its arguments, or None
+        n_arguments, content = self.macros[match.group(1)]
+        end = match.end()
+        if n_arguments == 0:
+            # like get_pattern_command_full, the name must be followed by a non-letter
+            if depth == 0 and end >= len(latex):
+                return None
+        arguments = []
+        for i in range(n_arguments):
+            argument = pattern_macro_argument.match(latex, end)
+            if argument is None:
+                return None
+            arguments.append(argument.group(2))
+            end = argument.end()
+        if n_arguments:
+            content = pattern_macro_parameter.sub(
+                lambda m: f' {arguments[int(m.group(1)) - 1]} ' if int(m.group(1)) <= n_arguments else m.group(),
+                content)
+        self.expansions += 1
+        if depth >= self.max_depth:
+            self.depth_exceeded += 1
         else:
-            n_arguments = int(n_arguments)
-        content = match.group(5)
-        latex = latex.replace(match.group(), f'{math_code}_REPLACE{count}_NEWCOMMAND')
-        full_newcommands.append(match.group(0))
-        latex = replace_newcommand((name, n_arguments, content), latex)
-        count += 1
-    for i in range(count):
-        latex = latex.replace(f'{math_code}_REPLACE{i}_NEWCOMMAND', full_newcommands[i])
-    return latex
-
-
-def remove_bibnote(latex):
-    pattern = regex.compile(get_pattern_command_full('bibinfo', 2), regex.DOTALL)
+            content = self.expand_text(content, 0, len(content), depth + 1)
+        return content, end
+
+    def expand_text(self, latex, start, end, depth=0):
+        # expand the macros used in latex[start:end]
+        pieces = []
+        pos = start
+        while True:
+            match = pattern_used_command.search(latex, pos, end)
+            if match is None:
+                break
+            if match.group(1) not in self.macros:
+                pieces.append(latex[pos:match.end()])
+                pos = match.end()
+                continue
+            expanded = self.expand_macro(latex, match, depth)
+            if expanded is None:
+                pieces.append(latex[pos:match.end()])
+                pos = match.end()
+                continue
+            pieces.append(latex[pos:match.start()])
+            pieces.append(expanded[0])
+            pos = expanded[1]
+        pieces.append(latex[pos:end])
+        return ''.join(pieces)
+
+    def expand(self):
+        if not self.macros:
+            return self.latex
+        time_start = time.time()
+        latex = self.latex
+        pieces = []
+        pos = 0
+        for start, end in self.definitions:
+            pieces.append(self.expand_text(latex, pos, start))
+            pieces.append(latex[start:end])
+            pos = end
+        pieces.append(self.expand_text(latex, pos, len(latex)))
+        latex = ''.join(pieces)
+        if self.used_names is not None:
+            for n_arguments, content in self.macros.values():
+                self.used_names.add(content)
+        self.time = time.time() - time_start
+        return latex
+
+
+def process_newcommands(latex, used_names=None):
+    return MacroExpander(latex, used_names).expand()
+
+
+def remove_bibnote(latex, used_names=None):
+    if used_names is not None and not used_names.has_command('bibinfo'):
+        return latex
+    pattern = compile_pattern_command_full('bibinfo', 2)
 
     def replace_function(match):
         assert match.group(1) == 'bibinfo'
@@ -0,0 +1,145 @@
+import io
+import os
+import re
+
+# a line which is only \input{xxx} or \include{xxx}, group 2: the path, the line is replaced by the file
+pattern_include_line = re.compile(r'^[^\S\n]*\\(input|include)\{(.+?)\}[^\n]*\n?', re.MULTILINE)
+# \input{xxx} anywhere in the text, group 1: the path
+pattern_input = re.compile(r'\\input{(.*?)}')
+
+
+def decode_source(data, encoding='utf-8', errors='ignore'):
+    # same text as open(..., encoding=encoding, errors=errors).read(), with universal newlines
+    return io.StringIO(data.decode(encoding, errors=errors), newline=None).read()
+
+
+def is_main_candidate(data):
+    r"""
+    Scans the bytes of a .tex file only as far as its first \begin{document} which is not in a comment.
+    Returns None if there is none, otherwise whether there is a \documentclass before it.
+    """
+    pos = data.find(b'\\begin{document}')
+    while pos != -1:
+        line_start = data.rfind(b'\n', 0, pos) + 1
+        if b'%' not in data[line_start:pos]:
+            return data.rfind(b'\\documentclass', 0, pos) != -1
+        pos = data.find(b'\\begin{document}', pos + 1)
+    return None
+
+
+class DirectorySources(dict):
+    # {path relative to base_dir: bytes} of the files of a directory, each one read when it is first used
+
+    def __init__(self, base_dir):
+        super().__init__()
+        self.base_dir = base_dir
+
+    def __missing__(self, name):
+        with open(os.path.join(self.base_dir, name), 'rb') as f:
+            data = f.read()
+        self[name] = data
+        return data
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or os.path.isfile(os.path.join(self.base_dir, name))
+
+
+class SourceTree:
+    r"""
+    The .tex files of a paper, in `sources` ({path: bytes}, e.g. from an archive, or DirectorySources).
+    find_main scores the candidates for the main file, and resolve replaces the includes found by `pattern`
+    (group 2, or the last group, is the path) by the files. Each file is decoded and scanned for includes
+    once, and the include graph (`graph`, `missing`) and the size of each file read (`byte_counts`) are kept.
+    get_encoding(data, name) gives the encoding of a file, otherwise utf-8 is used and errors are ignored.
+    """
+
+    def __init__(self, sources, get_encoding=None, pattern=pattern_include_line, preprocess=None):
+        self.sources = sources
+        self.get_encoding = get_encoding
+        self.pattern = pattern
+        self.preprocess = preprocess
+        self.main_dir = ''  # directory of the file being resolved, the includes are relative to it
+        self.segments = {}  # name: list of text and (included name or None, path)
+        self.graph = {}  # name: names of the included files which exist, in order
+        self.missing = {}  # name: paths of the included files which do not exist
+        self.byte_counts = {}
+
+    def text(self, name):
+        data = self.sources[name]
+        self.byte_counts[name] = len(data)
+        if self.get_encoding is None:
+            text = decode_source(data)
+        else:
+            text = decode_source(data, self.get_encoding(data, name), 'strict')
+        if self.preprocess is not None:
+            text = self.preprocess(text)
+        return text
+
+    def find_include(self, path):
+        # paths are relative to the directory of the main file, as for latex run there, then to the root of the
+        # sources. path.tex is tried first
+        paths = [path] if path.endswith('.tex') else [f'{path}.tex', path]
+        for base_dir in dict.fromkeys([self.main_dir, '']):
+            for sub_path in paths:
+                sub_name = os.path.normpath(os.path.join(base_dir, sub_path))
+                if sub_name in self.sources:
+                    return sub_name, sub_path
+        return None, paths[0]
+
+    def scan(self, name):
+        # split the file into text and includes, once
+        if name not in self.segments:
+            text = self.text(name)
+            segments = []
+            pos = 0
+            for match in self.pattern.finditer(text):
+                segments.append(text[pos:match.start()])
+                segments.append(self.find_include(match.group(match.lastindex)))
+                pos = match.end()
+            segments.append(text[pos:])
+            self.segments[name] = segments
+            self.graph[name] = [sub_name for sub_name, _ in segments[1::2] if sub_name is not None]
+            self.missing[name] = [path for sub_name, path in segments[1::2] if sub_name is None]
+        return self.segments[name]
+
+    def find_main(self, names=None):
+        r"""
+        The main file among the .tex files `names` (all of them by default): the ones with a \begin{document}
+        outside comments, those with a \documentclass first, then the ones closer to the root, in the given order.
+        Returns None if there is none.
+        """
+        if names is None:
+            names = [name for name in self.sources if name.endswith('.tex')]
+        candidates = []
+        for order, name in enumerate(names):
+            has_documentclass = is_main_candidate(self.sources[name])
+            if has_documentclass is not None:
+                candidates.append((not has_documentclass, name.count(os.sep), order, name))
+        return min(candidates)[-1] if candidates else None
+
+    def resolve(self, name, once=True):
+        # the text of `name` with the includes replaced by the files. With once=True each file is included once,
+        # otherwise at every include, except in itself
+        if os.path.dirname(name) != self.main_dir:
+            # the includes are found again from the new directory
+            self.main_dir = os.path.dirname(name)
+            self.segments, self.graph, self.missing = {}, {}, {}
+        pieces = []
+        visited = {name}
+        stack = [(name, iter(self.scan(name)))]
+        while stack:
+            segment = next(stack[-1][1], None)
+            if segment is None:
+                if not once:
+                    visited.discard(stack[-1][0])
+                stack.pop()
+            elif isinstance(segment, str):
+                pieces.append(segment)
+            else:
+                sub_name, path = segment
+                if sub_name is None:
+                    pieces.append(f'% WARNING: missing file {path}\n')
+                elif sub_name not in visited:
+                    visited.add(sub_name)
+                    stack.append((sub_name, iter(self.scan(sub_name))))
+        return ''.join(pieces)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of latex2txt import each other by name, as when the scripts are run from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,446 @@
+"""
+replace_latex_objects, which removes each object type in one scan with patterns compiled once, and the passes
+which take the compiled pattern of a name from the registry and are skipped by UsedNames when the name does not
+occur, against the versions they replaced, on generated paragraphs and random sequences of LaTeX tokens.
+"""
+import re
+import random
+import regex
+import pytest
+import latex_process
+from latex_process import (get_pattern_command_full, get_pattern_env, pattern_env, pattern_set1, pattern_set2,
+                           pattern_command_full, pattern_brace, pattern_command_simple, mularg_command_list,
+                           modify_text, modify_before, modify_after)
+
+
+# the previous versions, which compiled their pattern on every call and searched the text again after each object
+
+
+def replace_latex_objects_old(text, brace=True, command_simple=True):
+    patterns_mularg_command = [get_pattern_command_full(name, n) for name, n, index in mularg_command_list]
+    latex_obj_regex = [
+        r"\$\$(.*?)\$\$",  # $$ $$
+        r"\$(.*?)\$",  # $ $
+        r"\\\[(.*?)\\\]",  # \[ xxx \]
+        r"\\\((.*?)\\\)",  # \( xxx \)
+        pattern_env,  # \begin{xxx} \end{xxx}
+        pattern_set1,
+        pattern_set2,
+    ] + patterns_mularg_command + [pattern_command_full]  # \xxx[xxx]{xxx}
+    if brace:
+        latex_obj_regex.append(pattern_brace)
+    if command_simple:
+        latex_obj_regex.append(pattern_command_simple)  # \xxx
+    replaced_objs = []
+    for regex_symbol in latex_obj_regex:
+        pattern = regex.compile(regex_symbol, regex.DOTALL)
+        while pattern.search(text):
+            latex_obj = pattern.search(text).group()
+            replaced_objs.append(latex_obj)
+            text = pattern.sub(' ', text, 1)
+    text = modify_text(text, modify_before)
+    return text, replaced_objs
+
+
+def process_specific_command_old(latex, function, command_name):
+    pattern = regex.compile(get_pattern_command_full(command_name), regex.DOTALL)
+
+    def process_function(match):
+        options = match.group(2)
+        if options is None:
+            options = ''
+        return rf'\{command_name}{options}{{{function(match.group(4))}}}'
+    return pattern.sub(process_function, latex)
+
+
+def process_mularg_command_old(latex, function, command_tuple):
+    command_name, nargs, args_to_translate = command_tuple
+    pattern = regex.compile(get_pattern_command_full(command_name, n=nargs), regex.DOTALL)
+
+    def process_function(match):
+        contents = []
+        for i in range(nargs):
+            content = match.group(3 + 2 * i)
+            contents.append(function(content) if i in args_to_translate else content)
+        return rf'\{command_name}' + ''.join([rf'{{{content}}}' for content in contents])
+    return pattern.sub(process_function, latex)
+
+
+def delete_specific_format_old(latex, format_name):
+    pattern = regex.compile(get_pattern_command_full(format_name), regex.DOTALL)
+    return pattern.sub(lambda m: ' ' + m.group(4) + ' ', latex)
+
+
+def remove_bibnote_old(latex):
+    pattern = regex.compile(get_pattern_command_full('bibinfo', 2), regex.DOTALL)
+    return pattern.sub(lambda m: '' if m.group(3) == 'note' else m.group(0), latex)
+
+
+def remove_tex_comments_old(text):
+    math_code = latex_process.math_code
+    text = text.replace(r'\\', f'{math_code}_BLACKSLASH')
+    text = text.replace(r'\%', f'{math_code}_PERCENT')
+    text = re.sub(r"\n\s*%.*?(?=\n)", "", text)
+    text = re.sub(r"%.*?(?=\n)", "", text)
+    text = text.replace(f'{math_code}_PERCENT', r'\%')
+    text = text.replace(f'{math_code}_BLACKSLASH', r'\\')
+    return text
+
+
+def replace_accent_old(text):
+    def replace_function(match):
+        char = match.group(2) if match.group(2) is not None else match.group(3)
+        return latex_process.math_code + latex_process.special_character_forward[match.group(1)] + char
+    return re.compile(latex_process.pattern_accent).sub(replace_function, text)
+
+
+def replace_special_old(text):
+    for special in latex_process.list_special:
+        code = latex_process.special_character_forward[special]
+        text = text.replace(f'\\{special}', f' {latex_process.math_code}{code} ')
+    return text
+
+
+def recover_latex_objects_old(text, replaced_objs):
+    # the codes are replaced in passes over the whole text until there is none left
+    nobjs = len(replaced_objs)
+    matched_indices = []
+
+    def get_obj(digit_str):
+        index = int(''.join(digit_str.split('_')))
+        matched_indices.append(index)
+        if index < nobjs:
+            return replaced_objs[index]
+        return ''
+
+    text = modify_text(text, modify_after)
+    pattern = re.compile(latex_process.math_code + r"_(\d+(?:_\d+)*)*")
+    total_num = 0
+    while True:
+        text, num_modify = pattern.subn(lambda match: get_obj(match.group(1)), text)
+        total_num += num_modify
+        if num_modify == 0:
+            break
+    n_good = len(set(matched_indices).intersection(set(range(nobjs))))
+    n_bad1 = len(matched_indices) - n_good
+    n_bad2 = nobjs - n_good
+    return text, max(n_bad1, n_bad2), nobjs
+
+
+def process_specific_env_old(latex, function, env_name):
+    pattern = regex.compile(get_pattern_env(env_name), regex.DOTALL)
+
+    def process_function(match):
+        options = match.group(2)
+        if options is None:
+            options = ''
+        return rf'\begin{{{env_name}}}{options}{function(match.group(3))}\end{{{env_name}}}'
+    return pattern.sub(process_function, latex)
+
+
+def translate_latex_all_objects_old(latex, function, env_names, command_names):
+    # the passes of LatexTranslator.translate_latex_all_objects, one per name. The starred names are written
+    # back as \section* instead of \section\*, which process_latex_objects fixed
+    for env_name in env_names:
+        latex = process_specific_env_old(latex, function, env_name)
+        latex = process_specific_env_old(latex, function, env_name + r'\*')
+        latex = latex.replace(rf'{{{env_name}\*}}', f'{{{env_name}*}}')
+    for command_name in command_names:
+        latex = process_specific_command_old(latex, function, command_name)
+        latex = process_specific_command_old(latex, function, command_name + r'\*')
+        latex = latex.replace(rf'\{command_name}\*', rf'\{command_name}*')
+    for command_tuple in mularg_command_list:
+        latex = process_mularg_command_old(latex, function, command_tuple)
+    return latex
+
+
+def process_leading_level_brace_old(latex, function):
+    text, _ = replace_latex_objects_old(latex, brace=False)
+    braces_content = []
+
+    def process_function(match):
+        braces_content.append(rf'{{ {function(modify_text(match.group(1), modify_after))} }}')
+        return f'BRACE{len(braces_content) - 1}BRACE'
+
+    text = regex.compile(pattern_brace, regex.DOTALL).sub(process_function, text)
+    latex = modify_text(text, modify_after)
+    for i, content in enumerate(braces_content):
+        latex = latex.replace(f'BRACE{i}BRACE', content)
+    return latex
+
+words = ['the', 'model', 'We', 'results', 'a', 'Eq.', 'x_1', '\\pm', '1.5', 'é']
+commands = ['\\textbf', '\\textit', '\\emph', '\\section', '\\section*', '\\caption', '\\footnote', '\\cite', '\\ref',
+            '\\textcolor', '\\bibinfo', '\\foo', '\\bar', '\\alpha', '\\setlength', '\\\\']
+environments = ['equation', 'align*', 'itemize', 'abstract', 'proof', 'figure']
+tokens = ['$', '$$', '\\[', '\\]', '\\(', '\\)', '{', '}', '[', ']', ' ', '\n', '\\begin{', '\\end{', 'note', '%']
+
+
+def random_paragraph(r):
+    # a well formed paragraph of text, math, commands with options and arguments, and environments
+    pieces = []
+    for _ in range(r.randint(1, 40)):
+        c = r.random()
+        if c < 0.15:
+            pieces.append(r.choice(['$x_{%d}$', '$$a^{%d}$$', '\\[b_%d\\]', '\\(c + %d\\)']) % r.randint(0, 9))
+        elif c < 0.4:
+            command = r.choice(commands)
+            option = '[%s]' % r.choice(words) if r.random() < 0.2 else ''
+            nargs = r.choice([0, 1, 1, 2])
+            pieces.append(command + option + ''.join('{%s}' % ' '.join(r.choice(words) for _ in range(r.randint(0, 3)))
+                                                     for _ in range(nargs)))
+        elif c < 0.5:
+            environment = r.choice(environments)
+            pieces.append('\\begin{%s}%s\\end{%s}' % (environment, random_paragraph(r) if r.random() < 0.2 else 'x',
+                                                      environment))
+        elif c < 0.55:
+            pieces.append('{%s}' % r.choice(words))
+        elif c < 0.58:
+            pieces.append(r'\setlength{\parskip}{%dpt}' % r.randint(0, 9))
+        else:
+            pieces.append(r.choice(words))
+    return ' '.join(pieces)
+
+
+def random_tokens(r):
+    # any sequence of the tokens, with unbalanced braces, math delimiters and environments
+    pieces = []
+    for _ in range(r.randint(0, 30)):
+        c = r.random()
+        if c < 0.4:
+            pieces.append(r.choice(tokens))
+        elif c < 0.7:
+            pieces.append(r.choice(commands))
+        elif c < 0.8:
+            pieces.append(r.choice(environments) + '}')
+        else:
+            pieces.append(r.choice(words))
+    return ''.join(pieces)
+
+
+def random_inputs(seed, n):
+    r = random.Random(seed)
+    for _ in range(n):
+        yield random_paragraph(r) if r.random() < 0.5 else random_tokens(r)
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('brace, command_simple', [(True, True), (False, True), (False, False)])
+def test_replace_latex_objects(seed, brace, command_simple):
+    for latex in random_inputs(seed, 200):
+        assert (latex_process.replace_latex_objects(latex, brace, command_simple) ==
+                replace_latex_objects_old(latex, brace, command_simple))
+
+
+@pytest.mark.parametrize('latex', [r'\foo\bar{x}{y} z', r'\m\n\o{}{}{}', r'\m\m\h{}{}{}', r'\a \b\c{x} {y}{z}',
+                                   '\\m' * 30 + '{}' * 30, 'x \\m' * 30 + '{}' * 30])
+def test_replace_latex_objects_earlier_match(latex):
+    # removing \bar{x} lets \foo match with the argument which follows, and so on along a chain of commands
+    assert latex_process.replace_latex_objects(latex) == replace_latex_objects_old(latex)
+
+
+def mark(content):
+    return '<' + content + '>'
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_passes(seed):
+    # each pass gives the same text with the compiled patterns, with or without UsedNames to skip it
+    for latex in random_inputs(seed, 100):
+        for name in ['section', 'section\\*', 'caption', 'footnote', 'paragraph']:
+            expected = process_specific_command_old(latex, mark, name)
+            assert latex_process.process_specific_command(latex, mark, name) == expected
+            assert latex_process.process_specific_command(latex, mark, name, latex_process.UsedNames(latex)) == expected
+        for command_tuple in mularg_command_list:
+            expected = process_mularg_command_old(latex, mark, command_tuple)
+            assert latex_process.process_mularg_command(latex, mark, command_tuple) == expected
+            assert (latex_process.process_mularg_command(latex, mark, command_tuple, latex_process.UsedNames(latex)) ==
+                    expected)
+        for name in latex_process.format_list:
+            expected = delete_specific_format_old(latex, name)
+            assert latex_process.delete_specific_format(latex, name) == expected
+            assert latex_process.delete_specific_format(latex, name, latex_process.UsedNames(latex)) == expected
+        expected = remove_bibnote_old(latex)
+        assert latex_process.remove_bibnote(latex) == expected
+        assert latex_process.remove_bibnote(latex, latex_process.UsedNames(latex)) == expected
+
+
+def test_timeout_records():
+    # a call which runs out of its timeout falls back to the document tree and is recorded in the list it is given
+    latex = r'a \textbf{b} $c$ \begin{quote} d \end{quote} e'
+    records = []
+    text, replaced_objs = latex_process.replace_latex_objects(latex, timeout=0, records=records)
+    # the tree gives the objects in the order of the text
+    text_old, replaced_objs_old = replace_latex_objects_old(latex)
+    assert (text, sorted(replaced_objs)) == (text_old, sorted(replaced_objs_old))
+    assert [record['function'] for record in records] == ['replace_latex_objects']
+    assert records[0]['length'] == len(latex)
+    latex_process.replace_latex_objects(latex, timeout=0)
+    assert len(records) == 1
+
+
+preprocess_tokens = ['%', '\\%', '\\\\', '\\\\%', '\n', '\n  ', ' ', 'a', 'note', '{', '}', '\\mathbf',
+                     '\\mathbfx', '\\\\mathbf', '\\bibinfo{note}{x}', '\\bibinfo{title}{y}', '\\bibinfo',
+                     '\\"o', '\\"{o}', "\\'e", '\\`{A}', '\\^', '\\=', '\\.x', '\\\\"o', '\\&', '\\#', '\\$',
+                     '\\{', '\\}', '\\ ', '\\', '\\*']
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_preprocess_latex(seed):
+    # preprocess_latex and replace_accent_and_special against the chain of passes they replaced
+    r = random.Random(seed)
+    for _ in range(300):
+        latex = ''.join(r.choice(preprocess_tokens) for _ in range(r.randint(0, 30)))
+        if r.random() < 0.5:
+            latex += '\n'
+        expected = remove_bibnote_old(remove_tex_comments_old(latex).replace(r'\mathbf', r'\boldsymbol'))
+        assert latex_process.preprocess_latex(latex) == expected
+        assert latex_process.remove_tex_comments(latex) == remove_tex_comments_old(latex)
+        assert latex_process.replace_accent_and_special(latex) == replace_special_old(replace_accent_old(latex))
+        assert latex_process.replace_accent_and_special(expected) == replace_special_old(replace_accent_old(expected))
+
+
+def random_codes(r, indices, length):
+    # text and codes, with the underscores that modify_after escapes around them
+    return ' '.join(latex_process.variable_code(r.choice(indices)) if r.random() < 0.4 else
+                    r.choice(['a', 'x_1', 'b\\_c', '_', '$y$', '\\alpha']) for _ in range(r.randint(0, length)))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_recover_latex_objects(seed):
+    # the objects contain the codes of the objects after them, so that the old passes end, with repeated and
+    # missing indices, and codes of indices which are not in the objects
+    r = random.Random(seed)
+    for _ in range(200):
+        nobjs = r.randint(0, 15)
+        replaced_objs = [random_codes(r, list(range(i + 1, nobjs + 3)), 4) if r.random() < 0.5 else
+                         r.choice(['$x_1$', '\\textbf{a_b}', '\\alpha']) for i in range(nobjs)]
+        text = random_codes(r, list(range(nobjs + 3)), 20)
+        assert latex_process.recover_latex_objects(text, replaced_objs) == recover_latex_objects_old(text, replaced_objs)
+
+
+def test_recover_latex_objects_cases():
+    code = latex_process.variable_code
+    cases = [
+        # placeholder inside placeholder, twice
+        (f'a {code(0)} b {code(0)}', [f'\\textbf{{{code(1)}}}', f'${code(2)}_1$', 'x']),
+        # an index repeated in the objects and in the text, one missing
+        (f'{code(1)} {code(1)}_', [f'{code(1)}', f'[{code(2)} {code(2)}]', 'y', 'z']),
+        # out of range codes, a code of two digits and an object which is never used
+        (f'{code(5)} {code(12)} {code(13)} c', [f'{code(13)}'] * 12 + ['w']),
+    ]
+    for text, replaced_objs in cases:
+        assert latex_process.recover_latex_objects(text, replaced_objs) == recover_latex_objects_old(text, replaced_objs)
+
+
+def test_used_names():
+    used_names = latex_process.UsedNames(r'\section*{a} \begin{align*} x \end{align*} \foo\foo')
+    assert used_names.has_command('section\\*')
+    assert used_names.has_command('foo', count=2)
+    assert not used_names.has_command('caption')
+    assert used_names.has_environment('align')
+    assert not used_names.has_environment('itemize')
+    assert (used_names.passes_run, used_names.passes_skipped) == (3, 2)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_process_newcommands(seed):
+    # the macros whose names only occur in their definition are skipped with UsedNames
+    r = random.Random(seed)
+    for _ in range(50):
+        definitions = []
+        for i in range(r.randint(0, 4)):
+            name = r.choice(['foo', 'bar', 'baz'])
+            nargs = r.randint(0, 2)
+            body = ' '.join(r.choice(['#1', '#2', '\\section{#1}', '\\bar', 'x', '\\begin{equation}y\\end{equation}'])
+                            for _ in range(r.randint(1, 3)))
+            body = re.sub(r'#([1-9])', lambda m: m.group() if int(m.group(1)) <= nargs else '', body)
+            definitions.append('\\newcommand{\\%s}%s{%s}' % (name, '[%d]' % nargs if nargs else '', body))
+        latex = '\n'.join(definitions) + '\n' + random_paragraph(r) + ' \\foo{a}{b} \\baz'
+        assert (latex_process.process_newcommands(latex, latex_process.UsedNames(latex)) ==
+                latex_process.process_newcommands(latex))
+
+
+tree_words = ['the', 'model', 'We', 'x_1', 'Eq.', 'a.', r'\alpha the']
+tree_commands = ['section', 'section*', 'caption', 'footnote', 'textcolor', 'textbf', 'cite', 'foo']
+tree_environments = ['abstract', 'abstract*', 'itemize', 'proof', 'quote', 'equation', 'figure']
+tree_strays = ['{', '}', r'\begin{spacing}', r'\end{list}']
+
+
+def random_tree_latex(r, stray=0.0, depth=0, environments=()):
+    # nested commands, environments and groups, whose arguments follow the commands. Environments are not nested
+    # in one of the same name, and with probability stray, unbalanced braces and environments are added to the
+    # text outside the objects
+    pieces = []
+    for _ in range(r.randint(1, 12)):
+        c = r.random()
+        if c < 0.15:
+            pieces.append(r.choice(['$x_{%d}$', '$$a^{%d}$$', '\\[b_%d\\]', '\\(c + %d\\)']) % r.randint(0, 9))
+        elif c < 0.35 and depth < 3:
+            name = r.choice(tree_commands)
+            nargs = 2 if name == 'textcolor' else 1
+            option = '[%s]' % r.choice(tree_words) if nargs == 1 and r.random() < 0.2 else ''
+            pieces.append('\\' + name + option + ''.join('{%s}' % random_tree_latex(r, stray, depth + 1, environments)
+                                                         for _ in range(nargs)))
+        elif c < 0.45 and depth < 3:
+            name = r.choice([name for name in tree_environments if name.rstrip('*') not in environments])
+            content = random_tree_latex(r, stray, depth + 1, environments + (name.rstrip('*'), ))
+            pieces.append('\\begin{%s}%s\\end{%s}' % (name, content, name))
+        elif c < 0.55 and depth < 3:
+            pieces.append('{%s}' % random_tree_latex(r, stray, depth + 1, environments))
+        elif c < 0.6 and depth == 0 and r.random() < stray:
+            pieces.append(r.choice(tree_strays))
+        else:
+            pieces.append(r.choice(tree_words))
+    return ' '.join(pieces)
+
+
+def remove_objects(content):
+    # stands for the translate function, which removes the objects of what it is given
+    return '<' + latex_process.replace_latex_objects(content)[0] + '>'
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('stray', [0.0, 0.5])
+def test_process_latex_objects(seed, stray):
+    env_names = latex_process.environment_list
+    command_names = latex_process.command_list
+    r = random.Random(seed)
+    for _ in range(100):
+        latex = random_tree_latex(r, stray)
+        assert (latex_process.process_latex_objects(latex, remove_objects,
+                                                    env_names + [name + r'\*' for name in env_names],
+                                                    command_names + [name + r'\*' for name in command_names]) ==
+                translate_latex_all_objects_old(latex, remove_objects, env_names, command_names))
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('stray', [0.0, 0.5])
+def test_process_leading_level_brace(seed, stray):
+    r = random.Random(seed)
+    for _ in range(100):
+        latex = random_tree_latex(r, stray)
+        assert latex_process.process_leading_level_brace(latex, mark) == process_leading_level_brace_old(latex, mark)
+
+
+@pytest.mark.parametrize('latex', [
+    r'\textcolor{red \begin{quote}a\end{quote}}{b}',  # the objects of an argument which is not translated
+    r'{a \begin{quote} b} c',  # an environment which is never closed, in a group
+    r'\begin{abstract}a \begin{quote} b\end{abstract} {c \end{quote} d}',
+])
+def test_tree_unbalanced(latex):
+    env_names = latex_process.environment_list
+    command_names = latex_process.command_list
+    assert (latex_process.process_latex_objects(latex, remove_objects, env_names, command_names) ==
+            translate_latex_all_objects_old(latex, remove_objects, env_names, command_names))
+    assert latex_process.process_leading_level_brace(latex, mark) == process_leading_level_brace_old(latex, mark)
+
+
+def test_tree_behaviour_changes():
+    # the inputs on which the tree differs from the passes on purpose
+    # nested environments of the same name are matched properly instead of up to the first \end
+    latex = r'\begin{quote}a \begin{quote}b\end{quote} c\end{quote}'
+    expected = r'\begin{quote}<a   c>\end{quote}'
+    assert latex_process.process_latex_objects(latex, remove_objects, ['quote'], []) == expected
+    # a command followed by math and then a brace group does not take the group as its argument
+    assert latex_process.process_leading_level_brace(r'\R $x$ {a}', mark) == '    { <a> }'
+    assert process_leading_level_brace_old(r'\R $x$ {a}', mark) == ' '
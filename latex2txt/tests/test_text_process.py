@@ -0,0 +1,134 @@
+"""
+The linear connect_paragraphs, split_too_long_paragraphs and split_titles against the quadratic versions they
+replaced, on random texts with several char_limit values.
+"""
+import random
+import pytest
+import text_process
+
+
+# the previous versions, which deleted and re-split the lines in loops and recursions
+
+
+def connect_paragraphs_old(text):
+    text_split = text.split('\n')
+    i = 0
+    while i < len(text_split) - 1:
+        line_above = text_split[i]
+        line_below = text_split[i + 1]
+        if text_process.is_connected(line_above, line_below):
+            text_split[i] = text_split[i] + text_split[i + 1]
+            del text_split[i + 1]
+        else:
+            i += 1
+    return '\n'.join(text_split)
+
+
+def split_too_long_paragraphs_old(text, char_limit):
+    text_split = []
+    for paragraph in text.split('\n'):
+        if len(paragraph) > char_limit:
+            lines = paragraph.split('.')
+            first_words = [text_process.get_first_word(line) for line in lines]
+            first_length = [len(word) if (len(word) > 0 and word[0].isupper()) else 0 for word in first_words]
+            first_length[0] = 0
+            position = text_process.argmax(first_length)
+            par1 = split_too_long_paragraphs_old('.'.join(lines[0:position]) + '.', char_limit)
+            par2 = split_too_long_paragraphs_old('.'.join(lines[position:]), char_limit)
+            text_split.extend([par1, par2])
+        else:
+            text_split.append(paragraph)
+    return '\n'.join(text_split)
+
+
+def split_titles_old(text):
+    text_split = text.split('\n')
+    i = 0
+    while i < len(text_split) - 1:
+        line_above = text_split[i]
+        line_below = text_split[i + 1]
+        if text_process.is_title(line_above, line_below):
+            text_split[i] = '\n\n' + text_split[i] + '\n\n'
+        i += 1
+    return '\n'.join(text_split)
+
+
+words = ['the', 'model', 'We', 'Results', 'a', 'Table', 'x', 'In', 'figure', 'Our', 'é', 'Über', '1', '(see']
+
+
+def random_text(r, n_lines=30):
+    # lines of words, some ending with a dot, some empty, with sentences of all lengths
+    lines = []
+    for _ in range(r.randint(0, n_lines)):
+        c = r.random()
+        if c < 0.15:
+            lines.append('')
+            continue
+        pieces = []
+        for _ in range(r.randint(1, 40)):
+            word = r.choice(words)
+            pieces.append(word + '.' if r.random() < 0.2 else word)
+        line = (' ' * r.randint(0, 2)).join(pieces) if r.random() < 0.9 else ''.join(pieces)
+        lines.append(line + ('.' if r.random() < 0.4 else ''))
+    return '\n'.join(lines)
+
+
+def random_paragraph(r):
+    # a long line of sentences, most of them capitalized so that the old recursion can split it
+    sentences = []
+    for _ in range(r.randint(1, 200)):
+        pieces = [r.choice(words) for _ in range(r.randint(1, 8))]
+        if r.random() < 0.95:
+            pieces[0] = pieces[0].capitalize()
+        sentences.append(' ' * r.randint(0, 1) + ' '.join(pieces))
+    return '.'.join(sentences) + ('.' if r.random() < 0.5 else '')
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_connect_paragraphs(seed):
+    r = random.Random(seed)
+    for _ in range(100):
+        text = random_text(r)
+        assert text_process.connect_paragraphs(text) == connect_paragraphs_old(text)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_split_titles(seed):
+    r = random.Random(seed)
+    for _ in range(100):
+        text = random_text(r)
+        assert text_process.split_titles(text) == split_titles_old(text)
+
+
+@pytest.mark.parametrize('char_limit', [120, 300, 1000, 2000])
+def test_split_too_long_paragraphs(monkeypatch, char_limit):
+    monkeypatch.setattr(text_process, 'char_limit', char_limit)
+    r = random.Random(char_limit)
+    compared = 0
+    for _ in range(150):
+        text = '\n'.join(random_paragraph(r) if r.random() < 0.7 else random_text(r, 5) for _ in range(r.randint(1, 4)))
+        try:
+            expected = split_too_long_paragraphs_old(text, char_limit)
+        except RecursionError:
+            # the old recursion never ended on a part without a sentence to split at, the new one keeps it
+            continue
+        assert text_process.split_too_long_paragraphs(text) == expected
+        compared += 1
+    assert compared > 100
+
+
+def test_split_long_paragraph_without_split_point(monkeypatch):
+    monkeypatch.setattr(text_process, 'char_limit', 10)
+    paragraph = 'a long sentence. without capitals. at all'
+    with pytest.raises(RecursionError):
+        split_too_long_paragraphs_old(paragraph, 10)
+    assert text_process.split_too_long_paragraphs(paragraph) == paragraph
+
+
+def test_split_long_paragraph_deep(monkeypatch):
+    # far more sentences than the recursion limit allows to split one by one
+    monkeypatch.setattr(text_process, 'char_limit', 10)
+    paragraph = ' '.join('Word%d.' % i for i in range(5000))
+    parts = list(text_process.split_long_paragraph(paragraph))
+    assert len(parts) > 1
+    assert ''.join(parts) == paragraph
@@ -8,17 +8,19 @@ def is_connected(line_above, line_below):
 
 
 def connect_paragraphs(text):
-    text_split = text.split('\n')
-    i = 0
-    while i < len(text_split) - 1:
-        line_above = text_split[i]
-        line_below = text_split[i + 1]
-        if is_connected(line_above, line_below):
-            text_split[i] = text_split[i] + text_split[i + 1]
-            del text_split[i + 1]
+    # the lines of a paragraph are collected and joined once. The last line of a paragraph
+    # ends with the same character as the whole paragraph, because empty lines are never connected
+    paragraphs = []
+    current = []
+    for line in text.split('\n'):
+        if current and is_connected(current[-1], line):
+            current.append(line)
         else:
-            i += 1
-    return '\n'.join(text_split)
+            if current:
+                paragraphs.append(''.join(current))
+            current = [line]
+    paragraphs.append(''.join(current))
+    return '\n'.join(paragraphs)
 
 
 def get_first_word(line):
@@ -33,18 +35,57 @@ def argmax(array):
     return array.index(max(array))
 
 
+def get_first_length(line):
+    # length of the first word if it starts with an uppercase letter, otherwise 0
+    word = get_first_word(line)
+    return len(word) if (len(word) > 0 and word[0].isupper()) else 0
+
+
+def get_cartesian_tree(array):
+    # left and right child of each index (-1 if none) and the root. The root of the subtree
+    # which covers array[begin:end] is the first maximum in it, as given by argmax
+    left = [-1] * len(array)
+    right = [-1] * len(array)
+    stack = []
+    for i, value in enumerate(array):
+        last = -1
+        while stack and array[stack[-1]] < value:
+            last = stack.pop()
+        left[i] = last
+        if stack:
+            right[stack[-1]] = i
+        stack.append(i)
+    return left, right, stack[0] if stack else -1
+
+
+def split_long_paragraph(paragraph):
+    # split the sentences of `paragraph` in two before the longest capitalized first word, until each part
+    # is short enough. A part is the sentences lines[begin:end], followed by a '.' if it was the first half.
+    # It is split at the first maximum of the first lengths of lines[begin + 1:end], which is the root of a subtree
+    lines = paragraph.split('.')
+    first_length = [get_first_length(line) for line in lines[1:]]  # first_length[i] is of lines[i + 1]
+    left, right, root = get_cartesian_tree(first_length)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line) + 1)
+    parts = [(0, len(lines), False, root)]
+    while parts:
+        begin, end, dot, node = parts.pop()
+        length = offsets[end] - offsets[begin] - 1 + dot
+        if length <= char_limit or node == -1 or first_length[node] == 0:
+            # short enough, or there is no sentence to split at, so the part is kept as it is
+            yield '.'.join(lines[begin:end]) + ('.' if dot else '')
+            continue
+        position = node + 1
+        parts.append((position, end, dot, right[node]))
+        parts.append((begin, position, True, left[node]))
+
+
 def split_too_long_paragraphs(text):
     text_split = []
     for paragraph in text.split('\n'):
         if len(paragraph) > char_limit:
-            lines = paragraph.split('.')
-            first_words = [get_first_word(line) for line in lines]
-            first_length = [len(word) if (len(word) > 0 and word[0].isupper()) else 0 for word in first_words]
-            first_length[0] = 0
-            position = argmax(first_length)
-            par1 = split_too_long_paragraphs('.'.join(lines[0:position]) + '.')
-            par2 = split_too_long_paragraphs('.'.join(lines[position:]))
-            text_split.extend([par1, par2])
+            text_split.extend(split_long_paragraph(paragraph))
         else:
             text_split.append(paragraph)
     return '\n'.join(text_split)
@@ -59,13 +100,8 @@ def is_title(line_above, line_below):
 
 def split_titles(text):
     text_split = text.split('\n')
-    i = 0
-    while i < len(text_split) - 1:
-        line_above = text_split[i]
-        line_below = text_split[i + 1]
-        if is_title(line_above, line_below):
-            text_split[i] = '\n\n' + text_split[i] + '\n\n'
-        i += 1
-    return '\n'.join(text_split)
+    # the last line has no line below, so it is never a title
+    titles = [is_title(line_above, line_below) for line_above, line_below in zip(text_split, text_split[1:])] + [False]
+    return '\n'.join('\n\n' + line + '\n\n' if title else line for line, title in zip(text_split, titles))
 
 
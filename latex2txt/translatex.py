@@ -2,10 +2,13 @@
 import latex_process
 import text_process
 from latex_process import environment_list, command_list, format_list
-from encode_process import get_file_encoding
+from encode_process import read_file, decode_data
 import re
+import sys
+import time
 import cache
 import tqdm.auto
+import threading
 import concurrent.futures
 
 default_begin = r'''
@@ -20,16 +23,33 @@ default_end = r'''
 
 math_code = 'XMATHX'
 mularg_command_list = [('textcolor', 2, (1, ))]
+# seconds of regex matching for one paragraph, after which a cheaper strategy is used (see replace_latex_objects)
+default_regex_timeout = 10
 
 
 
+def is_gil_enabled():
+    # False on a free-threaded build of CPython (3.13t and later) which runs without the GIL
+    is_enabled = getattr(sys, '_is_gil_enabled', None)
+    return True if is_enabled is None else is_enabled()
+
+
 class LatexTranslator:
 
-    def __init__(self, debug=False, threads=0, char_limit=2000):
+    def __init__(self, debug=False, threads=0, char_limit=2000, regex_timeout=default_regex_timeout, concurrent=None):
         self.num = None
+        self.num_lock = threading.Lock()
+        # the number of the paragraph each thread is working on
+        self.paragraph = threading.local()
         self.theorems = None
+        self.used_names = None
+        self.macros_expanded = 0
+        self.macros_defined = 0
+        self.macros_seconds = 0
         self.debug = debug
         self.char_limit = char_limit
+        self.regex_timeout = regex_timeout
+        self.timeout_records = []
         if self.debug:
             self.f_old = open("text_old", "w", encoding='utf-8')
             self.f_new = open("text_new", "w", encoding='utf-8')
@@ -41,6 +61,13 @@ class LatexTranslator:
         else:
             self.threads = threads
 
+        # with the GIL, the threads only run in parallel while the regex module is matching with concurrent=True.
+        # Without it (free-threaded build), they already do
+        self.gil_enabled = is_gil_enabled()
+        if concurrent is None:
+            concurrent = self.gil_enabled and self.threads != 1
+        self.concurrent = concurrent
+
 
     def close(self):
         if self.debug:
@@ -81,7 +108,8 @@ class LatexTranslator:
     def extract_translatable_text(self, latex_original_paragraph):
 
         for format_name in format_list:
-            latex_original_paragraph = latex_process.delete_specific_format(latex_original_paragraph, format_name)
+            latex_original_paragraph = latex_process.delete_specific_format(latex_original_paragraph, format_name,
+                                                                            self.used_names)
 
         text_original_paragraph, objs = latex_process.replace_latex_objects(latex_original_paragraph)
         text_original_paragraph = latex_process.combine_split_to_sentences(text_original_paragraph)
@@ -95,17 +123,15 @@ class LatexTranslator:
 
 
         if self.debug:
-            print(f'\n\nParagraph {self.num}\n\n', file=self.f_old)
+            print(f'\n\nParagraph {getattr(self.paragraph, "num", self.num)}\n\n', file=self.f_old)
             print(text_original_paragraph, file=self.f_old)
 
         return text_original_paragraph
 
 
     def split_latex_to_paragraphs(self, latex):
-
-        text, _ = latex_process.replace_latex_objects(latex)  # 忽略 objs
-        paragraphs_text = re.split(r'\n\n+', text)
-        return paragraphs_text
+        # the objects are replaced later, in the threads, paragraph by paragraph
+        return latex_process.split_paragraphs(latex)
 
 
     def translate_text_in_paragraph_latex(self, paragraph):
@@ -125,15 +151,8 @@ class LatexTranslator:
     def translate_latex_all_objects(self, latex):
 
         translate_function = self.translate_text_in_paragraph_latex_and_leading_brace
-        for env_name in environment_list + self.theorems:
-            latex = latex_process.process_specific_env(latex, translate_function, env_name)
-            latex = latex_process.process_specific_env(latex, translate_function, env_name + r'\*')
-        for command_name in command_list:
-            latex = latex_process.process_specific_command(latex, translate_function, command_name)
-            latex = latex_process.process_specific_command(latex, translate_function, command_name + r'\*')
-        for command_group in mularg_command_list:
-            latex = latex_process.process_mularg_command(latex, translate_function, command_group)
-
+        latex = latex_process.process_latex_objects(latex, translate_function, environment_list + self.theorems,
+                                                    command_list, mularg_command_list, self.used_names)
         return latex
 
 
@@ -143,17 +162,25 @@ class LatexTranslator:
         return latex_cleaned
 
 
-    def worker(self, latex_original_paragraph):
+    def worker(self, latex_original_paragraph, num=None):
+        self.paragraph.num = num
         try:
-            text_only, _ = latex_process.replace_latex_objects(latex_original_paragraph)
-
-
-            text_only = latex_process.combine_split_to_sentences(text_only)
-            text_only = re.sub(r'  +', ' ', text_only).strip()
-            self.num += 1
-            return text_only
+            # the objects of the paragraph are removed, which may leave several paragraphs of text, then each
+            # of them is cleaned as a paragraph
+            text, _ = latex_process.replace_latex_objects(latex_original_paragraph, timeout=self.regex_timeout,
+                                                          concurrent=self.concurrent, records=self.timeout_records)
+            texts_only = []
+            for text_paragraph in re.split(r'\n\n+', text):
+                text_only, _ = latex_process.replace_latex_objects(text_paragraph, timeout=self.regex_timeout,
+                                                                   concurrent=self.concurrent,
+                                                                   records=self.timeout_records)
+                text_only = latex_process.combine_split_to_sentences(text_only)
+                texts_only.append(re.sub(r'  +', ' ', text_only).strip())
+            with self.num_lock:
+                self.num += len(texts_only)
+            return '\n\n'.join(texts_only)
         except BaseException as e:
-            print('Error found in Paragraph', self.num)
+            print('Error found in Paragraph', num)
             print('Content')
             print(latex_original_paragraph)
             raise e
@@ -170,15 +197,21 @@ class LatexTranslator:
 
         self.nbad = 0
         self.ntotal = 0
+        # the calls of replace_latex_objects which ran out of their timeout and fell back to the document tree
+        self.timeout_records = []
 
-        latex_original = latex_process.remove_tex_comments(latex_original)
-        latex_original = latex_original.replace(r'\mathbf', r'\boldsymbol')
+        # comments, \mathbf and \bibinfo{note}, then accents and \x specials, each group in one scan.
+        # \newcommand must be expanded in between to give the same result as running them one by one
+        latex_original = latex_process.preprocess_latex(latex_original)
+        self.used_names = latex_process.UsedNames(latex_original)
 
-        latex_original = latex_process.remove_bibnote(latex_original)
-        latex_original = latex_process.process_newcommands(latex_original)
+        expander = latex_process.MacroExpander(latex_original, self.used_names)
+        latex_original = expander.expand()
+        self.macros_expanded = expander.expansions
+        self.macros_defined = len(expander.macros)
+        self.macros_seconds = expander.time
 
-        latex_original = latex_process.replace_accent(latex_original)
-        latex_original = latex_process.replace_special(latex_original)
+        latex_original = latex_process.replace_accent_and_special(latex_original)
 
         self.complete = latex_process.is_complete(latex_original)
         self.theorems = latex_process.get_theorems(latex_original)
@@ -208,41 +241,75 @@ class LatexTranslator:
         self.num = 0
         # tqdm with concurrent.futures.ThreadPoolExecutor()
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
-            latex_translated_paragraphs = list(tqdm.auto.tqdm(executor.map(self.worker, latex_original_paragraphs),
+            latex_translated_paragraphs = list(tqdm.auto.tqdm(executor.map(self.worker, latex_original_paragraphs,
+                                                                           range(len(latex_original_paragraphs))),
                                                               total=len(latex_original_paragraphs)))
 
         latex_translated = '\n\n'.join(latex_translated_paragraphs)
         latex_translated = re.sub(r'\\?XMATHXBS[\s.,;:!?(){}]*', '', latex_translated)
         latex_translated = re.sub(r'\\?XMATHXSP[\s.,;:!?(){}]*', '', latex_translated)
 
+        for record in self.timeout_records:
+            print(f"Regex time budget exceeded in {record['function']} after {record['time']:.2f}s, "
+                  f"used the document tree for a paragraph of {record['length']} characters: "
+                  f"{record['paragraph'][:50]!r}")
         return latex_translated
 
 
 
 
-def process_latex_file(input, output):
-
-    input_encoding = get_file_encoding(input)
+def clean_text(text):
+    # blank lines and runs of spaces of the translated latex are collapsed
+    text_cleaned = re.sub(r'\n\s*\n+', '\n', text)
+    text_cleaned = re.sub(r'[ \t]+', ' ', text_cleaned)
+    return text_cleaned.strip()
+
+
+def convert_latex(latex, translator=None):
+    """
+    Converts a resolved latex document to the cleaned text, in memory: nothing is read or written on disk,
+    the cache of translate_full_latex included.
+
+    :param latex: The latex as a string, or as bytes which are decoded with the detected encoding
+    :param translator: The LatexTranslator to use, a default one if None
+    :return: The cleaned text and a dict of stats about the conversion
+    """
+    time_start = time.perf_counter()
+    input_bytes = None
+    if isinstance(latex, (bytes, bytearray)):
+        input_bytes = len(latex)
+        latex = decode_data(bytes(latex), '<latex in memory>')
+    if translator is None:
+        translator = LatexTranslator()
+    text_cleaned = clean_text(translator.translate_full_latex(latex, nocache=True))
+    stats = {
+        'input_bytes': input_bytes if input_bytes is not None else len(latex.encode('utf-8')),
+        'input_chars': len(latex),
+        'output_chars': len(text_cleaned),
+        'complete': translator.complete,
+        'paragraphs': translator.num,
+        'macros_expanded': translator.macros_expanded,
+        'macros_defined': translator.macros_defined,
+        'macros_seconds': translator.macros_seconds,
+        'regex_timeouts': len(translator.timeout_records),
+        'passes_run': translator.used_names.passes_run,
+        'passes_skipped': translator.used_names.passes_skipped,
+        'seconds': time.perf_counter() - time_start,
+    }
+    return text_cleaned, stats
 
-    with open(input, encoding=input_encoding) as f:
-        text_original = f.read()
 
-    translator = LatexTranslator()
-    text_final = translator.translate_full_latex(text_original)
+def process_latex_file(input, output):
 
-    text_cleaned = re.sub(r'\n\s*\n+', '\n', text_final)
-    text_cleaned = re.sub(r'[ \t]+', ' ', text_cleaned)
-    text_cleaned = text_cleaned.strip()
+    text_original = read_file(input)
 
+    text_cleaned, stats = convert_latex(text_original)
 
     with open(output, 'w', encoding='utf-8') as f:
         f.write(text_cleaned)
 
-    print(f" processing completed, result saved to {output}")
-
-
-
-
-
-
+    print(f"Expanded {stats['macros_expanded']} macros of {stats['macros_defined']} in {stats['macros_seconds']:.2f}s")
+    print(f"Skipped {stats['passes_skipped']} of {stats['passes_run'] + stats['passes_skipped']} passes "
+          f"for absent commands")
 
+    print(f" processing completed, result saved to {output}")
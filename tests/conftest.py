@@ -0,0 +1,108 @@
+import io
+import os
+import sys
+import asyncio
+import hashlib
+import tarfile
+import threading
+import pytest
+from aiohttp import web
+
+# the scripts of the repository import each other by name, as when they are run from its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import arXiv_download
+
+
+def make_tarball(text, size=200000):
+    # a .tar.gz of a main.tex of about size bytes, which does not compress, so that it is sent in many chunks
+    data = text.encode() + b'%' + os.urandom(size // 2).hex().encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tf:
+        info = tarfile.TarInfo('main.tex')
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class EprintServer:
+    # a local stand-in for the e-print endpoint of arXiv. The files are served with an ETag, and a Range request
+    # whose If-Range is the ETag (or which has no If-Range) is answered with the rest of the file.
+    # plans[number] lists what the next requests of a number are answered with, then 'ok':
+    #   'ok': as above, 416 if the range starts after the end of the file
+    #   'cut': as 'ok', but the connection is closed after half of the body
+    #   'full': the whole file with a 200, whatever the Range
+    #   '503': a 503 with a Retry-After of retry_after seconds
+    # requests lists the (number, headers) of each request, and sent[number] the bytes of the bodies sent
+
+    def __init__(self):
+        self.files = {}
+        self.plans = {}
+        self.requests = []
+        self.sent = {}
+        self.retry_after = '1'
+        self.url = None
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+
+    def add(self, number, text='paper'):
+        # serve a new tarball as the e-print of number, returns its content
+        self.files[number] = make_tarball(text)
+        return self.files[number]
+
+    def etag(self, number):
+        return '"' + hashlib.md5(self.files[number]).hexdigest() + '"'
+
+    async def handle(self, request):
+        number = request.match_info['number']
+        self.requests.append((number, dict(request.headers)))
+        if number not in self.files:
+            return web.Response(status=404)
+        plan = self.plans.get(number)
+        action = plan.pop(0) if plan else 'ok'
+        if action == '503':
+            return web.Response(status=503, headers={'Retry-After': self.retry_after})
+        body = self.files[number]
+        etag = self.etag(number)
+        start = 0
+        range_header = request.headers.get('Range')
+        if action != 'full' and range_header and request.headers.get('If-Range', etag) == etag:
+            start = int(range_header[len('bytes='):-1])
+            if start >= len(body):
+                return web.Response(status=416, headers={'Content-Range': f'bytes */{len(body)}'})
+        part = body[start:]
+        headers = {'ETag': etag, 'Content-Length': str(len(part))}
+        if start:
+            headers['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+        response = web.StreamResponse(status=206 if start else 200, headers=headers)
+        await response.prepare(request)
+        if action == 'cut':
+            part = part[:len(part) // 2]
+        await response.write(part)
+        self.sent[number] = self.sent.get(number, 0) + len(part)
+        if action == 'cut':
+            request.transport.close()
+        return response
+
+    def start(self):
+        app = web.Application()
+        app.router.add_get('/e-print/{number:.+}', self.handle)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        host, port = self.runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}/e-print'
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@pytest.fixture
+def eprint_server(monkeypatch):
+    server = EprintServer()
+    server.start()
+    monkeypatch.setattr(arXiv_download, 'eprint_url', server.url)
+    yield server
+    server.stop()
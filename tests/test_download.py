@@ -0,0 +1,150 @@
+"""
+The resumed downloads of arXiv_download against a local stand-in for the e-print endpoint: Range and If-Range,
+a server which answers a Range request with the whole file, 416, and Retry-After.
+"""
+import os
+import time
+import asyncio
+import arXiv_download
+
+
+def download_async(number, path, retries=3, backoff=0.0):
+    results = asyncio.run(arXiv_download.download_sources_async([(number, path)], retries=retries, backoff=backoff))
+    return results[number]
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_part(path, data, validator=None):
+    with open(f'{path}.part', 'wb') as f:
+        f.write(data)
+    if validator is not None:
+        with open(f'{path}.part.validator', 'w', encoding='utf-8') as f:
+            f.write(validator)
+
+
+def test_download(eprint_server, tmp_path):
+    eprint_server.add('2203.01252v1')
+    path = str(tmp_path / '2203.01252v1.tar.gz')
+    assert arXiv_download.download_source('2203.01252v1', path)
+    assert read(path) == eprint_server.files['2203.01252v1']
+    assert not os.path.exists(f'{path}.part')
+    assert arXiv_download.load_checksums(str(tmp_path)) == {
+        '2203.01252v1.tar.gz': arXiv_download.file_sha256(path)}
+
+
+def test_resume_with_range(eprint_server, tmp_path):
+    body = eprint_server.add('1')
+    path = str(tmp_path / '1.tar.gz')
+    write_part(path, body[:len(body) // 3], eprint_server.etag('1'))
+    assert arXiv_download.download_source('1', path)
+    assert read(path) == body
+    _, headers = eprint_server.requests[-1]
+    assert headers['Range'] == f'bytes={len(body) // 3}-'
+    assert headers['If-Range'] == eprint_server.etag('1')
+    assert eprint_server.sent['1'] == len(body) - len(body) // 3
+
+
+def test_resume_after_cut(eprint_server, tmp_path):
+    # the connection is closed in the middle of the body, the retry asks for the rest only
+    body = eprint_server.add('1')
+    eprint_server.plans['1'] = ['cut']
+    path = str(tmp_path / '1.tar.gz')
+    assert download_async('1', path)
+    assert read(path) == body
+    assert [headers.get('Range') for _, headers in eprint_server.requests] == [None, f'bytes={len(body) // 2}-']
+    assert eprint_server.sent['1'] == len(body)
+
+
+def test_resume_sync_after_cut(eprint_server, tmp_path):
+    # the .part of an interrupted download is kept with the ETag, and resumed by the next call
+    body = eprint_server.add('1')
+    eprint_server.plans['1'] = ['cut']
+    path = str(tmp_path / '1.tar.gz')
+    assert not arXiv_download.download_source('1', path)
+    assert os.path.getsize(f'{path}.part') == len(body) // 2
+    assert read(f'{path}.part.validator').decode() == eprint_server.etag('1')
+    assert arXiv_download.download_source('1', path)
+    assert read(path) == body
+
+
+def test_if_range_of_another_version(eprint_server, tmp_path):
+    # the .part was started from another version of the file, the server answers with the whole new one
+    body = eprint_server.add('1', 'paper v2')
+    path = str(tmp_path / '1.tar.gz')
+    write_part(path, b'\x1f\x8b' + os.urandom(1000), '"v1"')
+    assert arXiv_download.download_source('1', path)
+    assert read(path) == body
+    _, headers = eprint_server.requests[-1]
+    assert headers['Range'] == 'bytes=1002-'
+    assert headers['If-Range'] == '"v1"'
+    assert eprint_server.sent['1'] == len(body)
+    assert not os.path.exists(f'{path}.part')
+    assert not os.path.exists(f'{path}.part.validator')
+
+
+def test_200_answered_to_range(eprint_server, tmp_path):
+    # a server which does not support ranges sends the whole file, which replaces the .part instead of being
+    # appended to it
+    body = eprint_server.add('1')
+    eprint_server.plans['1'] = ['full']
+    path = str(tmp_path / '1.tar.gz')
+    write_part(path, body[:5000], eprint_server.etag('1'))
+    assert arXiv_download.download_source('1', path)
+    assert read(path) == body
+
+    eprint_server.plans['1'] = ['full']
+    os.remove(path)
+    write_part(path, body[:5000], eprint_server.etag('1'))
+    assert download_async('1', path)
+    assert read(path) == body
+
+
+def test_416(eprint_server, tmp_path):
+    # the .part is longer than the file: the server answers 416 and the .part is discarded
+    body = eprint_server.add('1')
+    path = str(tmp_path / '1.tar.gz')
+    write_part(path, body + b'garbage', eprint_server.etag('1'))
+    assert not arXiv_download.download_source('1', path)
+    assert not os.path.exists(f'{path}.part')
+    assert not os.path.exists(f'{path}.part.validator')
+    assert arXiv_download.download_source('1', path)
+    assert read(path) == body
+
+    # the async download asks again from the start after the 416
+    os.remove(path)
+    write_part(path, body + b'garbage', eprint_server.etag('1'))
+    eprint_server.requests.clear()
+    assert download_async('1', path)
+    assert read(path) == body
+    assert [headers.get('Range') for _, headers in eprint_server.requests] == [f'bytes={len(body) + 7}-', None]
+
+
+def test_retry_after(eprint_server, tmp_path):
+    # with no backoff, the retry waits for the Retry-After of the server only
+    body = eprint_server.add('1')
+    eprint_server.plans['1'] = ['503']
+    eprint_server.retry_after = '1'
+    path = str(tmp_path / '1.tar.gz')
+    time_start = time.monotonic()
+    assert download_async('1', path, backoff=0.0)
+    assert time.monotonic() - time_start >= 1
+    assert read(path) == body
+    assert len(eprint_server.requests) == 2
+
+
+def test_retry_delay():
+    assert arXiv_download.get_retry_delay(3, 1.0, '2') == 2.0
+    # a Retry-After which is an HTTP date is not used
+    assert 0 <= arXiv_download.get_retry_delay(3, 1.0, 'Wed, 21 Oct 2026 07:28:00 GMT') <= 8.0
+    assert 0 <= arXiv_download.get_retry_delay(0, 1.0) <= 1.0
+
+
+def test_not_found(eprint_server, tmp_path):
+    path = str(tmp_path / '1.tar.gz')
+    assert not download_async('1', path)
+    assert len(eprint_server.requests) == 1
+    assert not os.path.exists(path)